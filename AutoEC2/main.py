@@ -4,12 +4,21 @@ Licensed under the Apache License, Version 2.0
 THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
 This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
 --------------------------------------------------------------------------------------------------------------------"""
-import boto3
+import sys
+import os
+"""autoec2_common (shared with AutoEC2x) is in the repository root"""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 from botocore import exceptions as bc
 from halo import Halo
+from autoec2_common.cache import MetadataCache, credentials_fingerprint
+from autoec2_common.clients import ClientFactory
+from autoec2_common.base_images import find_base_image, instance_architecture
+from autoec2_common.poller import InstancePoller, has_public_ips
+from autoec2_common.addresses import AddressPool
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import argparse
 import time
-import sys
-import os
 from datetime import datetime
 import secrets
 import urllib.request
@@ -17,10 +26,38 @@ import urllib.request
 ######################################################################################################################
 #                                                       Functions                                                    #
 ######################################################################################################################
+def pause(seconds):
+    """Cosmetic delay between steps, skipped when replaying an answers file"""
+    if answers['replay'] is None:
+        time.sleep(seconds)
+    return None
+
+
+def ask(prompt, secret=False):
+    """Prompt for input, or take the next answer from the answers file when replaying
+
+    When recording, every answer is written to the answers file as it's given. Credentials (<secret>) are never
+    written, they're recorded as a placeholder and asked for again on replay.
+    """
+    if answers['replay'] is not None:
+        if not answers['replay']:
+            raise SystemExit(f"The answers file has no answer for: {prompt}")
+        answer = answers['replay'].pop(0)
+        if answer == secret_placeholder:
+            return input(prompt)
+        print(f"{prompt}{answer}")
+        return answer
+    answer = input(prompt)
+    if answers['record'] is not None:
+        answers['record'].write(f"{secret_placeholder if secret else answer}\n")
+        answers['record'].flush()
+    return answer
+
+
 def start_spinner(busy_text='Loading', t=1):
     spin = Halo(text=f'{busy_text}', color='cyan', spinner='dots')
     spin.start()
-    time.sleep(t)
+    pause(t)
     return spin
 
 
@@ -40,7 +77,7 @@ def delay_print_slow(s):
     for c in s:
         sys.stdout.write(c)
         sys.stdout.flush()
-        time.sleep(0.2)
+        pause(0.2)
     return None
 
 
@@ -62,8 +99,22 @@ def delay_print_slow(s):
 #     return None
 
 
+def strip_metadata(response):
+    return {key: value for key, value in response.items() if key != 'ResponseMetadata'}
+
+
+def get_identity():
+    """Return the caller identity for the configured credentials, from the cache when possible"""
+    credentials = clients.session.get_credentials()
+    if credentials is None:
+        raise bc.NoCredentialsError()
+    return metadata_cache.fetch(credentials_fingerprint(credentials), '', 'get_caller_identity',
+                                lambda: strip_metadata(clients.client('sts').get_caller_identity()))
+
+
 def load_regions():
-    regions = [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
+    regions = metadata_cache.fetch(account, '', 'describe_regions',
+                                   lambda: [region['RegionName'] for region in ec2_client.describe_regions()['Regions']])
     region_count = [i for i in range(1, len(regions) + 1)]
     region_dict = {i: j for i, j in zip(region_count, regions)}
     return regions, region_count, region_dict
@@ -81,21 +132,39 @@ def ec2_instance_types(ec2_client):
     return None
 
 
-def print_instance_types(ec2_client):
-    result = [ec2_type for ec2_type in ec2_instance_types(ec2_client)]
-    result.sort()
+def print_instance_types(instance_type_list):
+    result = sorted(instance_type_list)
     for ec2_type in result:
         print(ec2_type)
     return None
 
 
 def get_external_ip():
-    spin = start_spinner(busy_text='Getting your external IP address...')
     external_ip = urllib.request.urlopen('http://ident.me').read().decode('utf8')
-    spin.stop()
     return external_ip
 
 
+def prefetch(key, loader):
+    """Start <loader> on a background thread, so the result is ready by the time the wizard needs it"""
+    background[key] = {'loader': loader, 'future': prefetcher.submit(loader)}
+    return None
+
+
+def prefetched(key, busy_text):
+    """Return the background result for <key>, the spinner is only shown if it is still loading"""
+    future = background[key]['future']
+    spin = None if future.done() else start_spinner(busy_text=busy_text, t=0)
+    try:
+        return future.result()
+    except Exception:
+        """Start it again, so the section's retry doesn't get the same error"""
+        prefetch(key, background[key]['loader'])
+        raise
+    finally:
+        if spin is not None:
+            spin.stop()
+
+
 def custom_sg_rule(port, custom_ip):
     custom_rule = {
         'IpProtocol': 'tcp',
@@ -119,30 +188,52 @@ def customtv_sg_rule(port, custom_ip):
 ######################################################################################################################
 #                                                    Initialize                                                      #
 ######################################################################################################################
+parser = argparse.ArgumentParser(description='MML Auto-EC2 Generator')
+parser.add_argument('--refresh', action='store_true', help='Ignore cached AWS metadata and fetch it again')
+parser.add_argument('--clear-cache', action='store_true', help='Delete all cached AWS metadata before running')
+answers_group = parser.add_mutually_exclusive_group()
+answers_group.add_argument('--record', metavar='FILE', help='Save your answers to FILE so the session can be replayed')
+answers_group.add_argument('--replay', metavar='FILE', help='Answer every prompt from FILE, without the cosmetic delays')
+args = parser.parse_args()
+
+secret_placeholder = '<not recorded>'
+answers = {'replay': None, 'record': None}
+if args.replay:
+    with open(args.replay) as answers_file:
+        answers['replay'] = answers_file.read().splitlines()
+if args.record:
+    answers['record'] = open(args.record, 'w')
+metadata_cache = MetadataCache(refresh=args.refresh)
+if args.clear_cache:
+    metadata_cache.invalidate()
+"""Every client comes from one session, so connections are reused between the wizard's steps"""
+clients = ClientFactory()
+prefetcher = ThreadPoolExecutor(max_workers=5)
+background = {}
+
 start_time = time.time()
 started = datetime.now().strftime("%Y-%m-%d %I:%M:%S")
 yes_list = ['yes', 'Yes', 'y', 'ye', 'Ye']
 no_list = ['no', 'No', 'n', 'exit', 'Exit', 'new', 'New']
-image_id = 'ami-0fb653ca2d3203ac1'  # Ubuntu 20.04 LTS
 dry_run = False
 delay_print_fast("Welcome to the MML Auto-EC2 Generator")
 delay_print_slow("... ")
 delay_print_fast("Make an instance you deserve")
 print("")
-time.sleep(1)
+pause(1)
 print('You will need an AWS account to continue, if you do not currently have an account, please create one here: '
       'https://portal.aws.amazon.com/billing/signup?#/start')
-time.sleep(1)
-input(f"Press any key to continue")
+pause(1)
+ask(f"Press any key to continue")
 
 ######################################################################################################################
 #                                                       Login                                                        #
 ######################################################################################################################
 """Login or Configure AWS"""
 try:
-    sts = boto3.client('sts')
-    cid = sts.get_caller_identity()
-    ec2_client = boto3.client('ec2')
+    cid = get_identity()
+    account = cid['Account']
+    ec2_client = clients.client('ec2')
     default_region = ec2_client.meta.region_name
     print(f"Credentials are valid. Logged in as {cid['UserId']}. Your default region is {default_region}.")
 
@@ -152,28 +243,28 @@ except bc.NoCredentialsError:
           "https://console.aws.amazon.com/iam/home?#/security_credentials")
 
     while True:
-        aws_access_key_id = input("Please enter your AWS Access Key ID (e.g. BRLO5fZMGMLRZV843HX9): ")
+        aws_access_key_id = ask("Please enter your AWS Access Key ID (e.g. BRLO5fZMGMLRZV843HX9): ", secret=True)
         aws_access_key_id = aws_access_key_id.replace(" ", "").replace("-", "").replace(",", "").replace(".", "")
-        key_check = input(f"You've entered '{aws_access_key_id}', is this correct (y/n): ")
+        key_check = ask(f"You've entered '{aws_access_key_id}', is this correct (y/n): ")
         if key_check in yes_list:
             break
         print("Please try again")
     while True:
-        aws_secret_access_key = input(
-            "Please enter your AWS Secret Access Key (e.g. K3FH68epJG0LglLT7hYtMfr4nXFWsB5zKSipLZWm): ")
+        aws_secret_access_key = ask(
+            "Please enter your AWS Secret Access Key (e.g. K3FH68epJG0LglLT7hYtMfr4nXFWsB5zKSipLZWm): ", secret=True)
         aws_secret_access_key = aws_secret_access_key.replace(" ", "").replace("-", "").replace(",", "").replace(".",
                                                                                                                  "")
-        key_check = input(f"You've entered '{aws_secret_access_key}', is this correct (y/n): ")
+        key_check = ask(f"You've entered '{aws_secret_access_key}', is this correct (y/n): ")
         if key_check in yes_list:
             break
         print("Please try again")
     while True:
         print("Next, we will choose a default region, to review a list of all available regions please visit this link: "
               "https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/using-regions-availability-zones.html#concepts-available-regions")
-        time.sleep(1)
-        account_region = input("Please enter your default region (e.g. us-east-2): ")
+        pause(1)
+        account_region = ask("Please enter your default region (e.g. us-east-2): ")
         account_region = account_region.replace(" ", "").replace(",", "").replace(".", "")
-        key_check = input(f"You've entered '{account_region}', is this correct (y/n): ")
+        key_check = ask(f"You've entered '{account_region}', is this correct (y/n): ")
         if key_check in yes_list:
             break
         print("Please try again")
@@ -202,25 +293,27 @@ except bc.NoCredentialsError:
         credentials_file.write(f"aws_access_key_id = {aws_access_key_id}\n")
         credentials_file.write(f"aws_secret_access_key = {aws_secret_access_key}\n")
 
-    ec2_client = boto3.client('ec2', region_name=account_region)
+    clients = ClientFactory()
+    ec2_client = clients.client('ec2', account_region)
     default_region = ec2_client.meta.region_name
-    time.sleep(2)
+    account = get_identity()['Account']
+    pause(2)
     spin.stop()
 
-time.sleep(1)
+pause(1)
 ######################################################################################################################
 #                                                       Regions                                                      #
 ######################################################################################################################
 while True:
     try:
         spin = start_spinner(busy_text='Loading Regions...')
-        ec2_client = boto3.client('ec2')
+        ec2_client = clients.client('ec2')
         regions, region_count, region_dict = load_regions()
         spin.stop()
 
         print("Next, we will choose your desired region for your EC2 instance. To learn about AWS regions, please visit this "
               "link: https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/using-regions-availability-zones.html")
-        time.sleep(1)
+        pause(1)
 
         default_region = ec2_client.meta.region_name
         default_region_number = [key for key, value in region_dict.items() if value == default_region][0]
@@ -229,21 +322,21 @@ while True:
         selected_region = default_region
 
         """Get Desired Region"""
-        confirm_default_region = input(f"Would you like to use your default region ({default_region})? (y/n) ")
+        confirm_default_region = ask(f"Would you like to use your default region ({default_region})? (y/n) ")
         if confirm_default_region in yes_list:
             print(f"********************************************************************************************\n"
                   f"You've confirmed your region as: {default_region}"
                   f"\n********************************************************************************************")
             selected_region = default_region
         else:
-            sel0 = input(f"Would you like to review a list of regions? (y/n) ")
+            sel0 = ask(f"Would you like to review a list of regions? (y/n) ")
             while sel2 not in yes_list:
                 if sel0 in no_list:
-                    sel = input(f"Please enter a region, your default region is {default_region} (#{default_region_number}): ")
+                    sel = ask(f"Please enter a region, your default region is {default_region} (#{default_region_number}): ")
                     if sel not in regions:
                         print("This is not a valid region, please try again")
                     else:
-                        sel2 = input(f"You've selected {sel}, is this correct? (y/n): ")
+                        sel2 = ask(f"You've selected {sel}, is this correct? (y/n): ")
                         if sel2 not in yes_list:
                             print("Please choose again")
                         else:
@@ -254,16 +347,16 @@ while True:
                 else:
                     for key, value in region_dict.items():
                         print(f"{key}. {value}")
-                    time.sleep(.5)
+                    pause(.5)
                     print(f"Please review the available regions from the list above, the default region is {default_region} (#{default_region_number}: ")
-                    time.sleep(0.5)
+                    pause(0.5)
                     while sel2 not in yes_list:
                         try:
-                            sel = int(input(f"Please select a region (1-{len(region_dict)}): "))
+                            sel = int(ask(f"Please select a region (1-{len(region_dict)}): "))
                             if len(regions) <= sel <= 0:
                                 print("This is not a valid region, please try again")
                             else:
-                                sel2 = input(f"You've selected {region_dict[sel]}, is this correct? (y/n): ")
+                                sel2 = ask(f"You've selected {region_dict[sel]}, is this correct? (y/n): ")
                                 if sel2 not in yes_list:
                                     print("Please choose again")
                         except Exception:
@@ -273,38 +366,51 @@ while True:
                           f"\n********************************************************************************************")
                     selected_region = region_dict[sel]
 
-        ec2_client = boto3.client('ec2', region_name=selected_region)
+        ec2_client = clients.client('ec2', selected_region)
     except Exception:
         continue
     break
 
-time.sleep(1)
+"""The region won't change from here, so start loading the next sections while the user answers the prompts"""
+region_calls = {
+    'describe_instance_types': lambda: list(ec2_instance_types(ec2_client)),
+    'describe_subnets': lambda: strip_metadata(ec2_client.describe_subnets()),
+    'describe_security_groups': lambda: strip_metadata(ec2_client.describe_security_groups()),
+    'describe_vpcs': lambda: strip_metadata(ec2_client.describe_vpcs()),
+    'base_image:x86_64': lambda: find_base_image(clients, selected_region, 'x86_64'),
+}
+for call, loader in region_calls.items():
+    prefetch(call, functools.partial(metadata_cache.fetch, account, selected_region, call, loader))
+prefetch('external_ip', get_external_ip)
+"""Take a free Elastic IP from the pool now, so it is ready when the instance is. A new address is billed, so one is
+only allocated once the instance has been created"""
+address_pool = AddressPool(ec2_client, dry_run=dry_run)
+prefetch('elastic_ip', functools.partial(address_pool.acquire, allocate=False))
+
+pause(1)
 ######################################################################################################################
 #                                                Instance Types                                                      #
 ######################################################################################################################
 while True:
     try:
-        spin = start_spinner(busy_text='Loading Instance Types...')
-        """Reset Client with Region Selected"""
-        instance_type_list = [ec2_type for ec2_type in ec2_instance_types(ec2_client)]
-        spin.stop()
+        instance_type_list = prefetched('describe_instance_types', 'Loading Instance Types...')
 
         print("Now, we will choose your desired instance type, to review instance specs, please visit this link: "
               "https://aws.amazon.com/ec2/instance-types/")
-        time.sleep(1)
+        pause(1)
 
-        sel3 = input(f"Would you like to review a list of instance types available in your region? (y/n): ")
+        sel3 = ask(f"Would you like to review a list of instance types available in your region? (y/n): ")
         if sel3 in yes_list:
-            print_instance_types(ec2_client)
+            print_instance_types(instance_type_list)
 
         default_instance = 't2.micro'
         sel4 = 't2.micro'
         """Get Desired Instance Type"""
         while True:
             try:
-                sel4 = input(f"Please enter your desired instance type, the default type is {default_instance}: ")
+                sel4 = ask(f"Please enter your desired instance type, the default type is {default_instance}: ")
                 if sel4 in instance_type_list:
-                    sel2 = input(f"You've selected {sel4}, is this correct? (y/n) ")
+                    sel2 = ask(f"You've selected {sel4}, is this correct? (y/n) ")
                     if sel2 not in yes_list:
                         print("Please choose again")
                         continue
@@ -322,20 +428,29 @@ while True:
         continue
     break
 
-time.sleep(1)
+"""The Ubuntu image differs per region and architecture, find it before anything is created"""
+architecture = metadata_cache.fetch(account, selected_region, f'instance_architecture:{selected_type}',
+                                    lambda: instance_architecture(ec2_client.describe_instance_types(
+                                        InstanceTypes=[selected_type])['InstanceTypes'][0]['ProcessorInfo'][
+                                        'SupportedArchitectures']))
+if f'base_image:{architecture}' not in background:
+    prefetch(f'base_image:{architecture}', functools.partial(
+        metadata_cache.fetch, account, selected_region, f'base_image:{architecture}',
+        lambda: find_base_image(clients, selected_region, architecture)))
+image_id = prefetched(f'base_image:{architecture}', 'Finding the Ubuntu image for your region...')
+
+pause(1)
 ######################################################################################################################
 #                                                       Subnet                                                      #
 ######################################################################################################################
 while True:
     try:
-        spin = start_spinner(busy_text='Loading Subnets...')
-        sn_all = ec2_client.describe_subnets()
+        sn_all = prefetched('describe_subnets', 'Loading Subnets...')
         sn_all = {key: value for key, value in sorted(sn_all.items())}
-        spin.stop()
 
         print("Now, we will choose your desired subnet, to learn more about subnets, please visit this link: "
               "https://docs.aws.amazon.com/vpc/latest/userguide/VPC_Subnets.html#subnet-basics")
-        time.sleep(1)
+        pause(1)
 
         """Choose Subnet"""
         subnet_dict = {}
@@ -343,7 +458,7 @@ while True:
             subnet = sn_all['Subnets'][i]
             print(f"{i+1}. {subnet['AvailabilityZone']}")
             subnet_dict[subnet['AvailabilityZone']] = subnet['SubnetId']
-            time.sleep(.25)
+            pause(.25)
 
         subnet_list = [*subnet_dict]
         default_subnet = subnet_list[0]
@@ -351,9 +466,9 @@ while True:
         """Get Desired Subnet"""
         while True:
             try:
-                sel5 = input(f"Please enter your desired subnet (1-3), the default type is {default_subnet}: ")
+                sel5 = ask(f"Please enter your desired subnet (1-3), the default type is {default_subnet}: ")
                 sel5 = subnet_list[int(sel5)-1]
-                sel6 = input(f"You've selected {sel5}, is this correct? (y/n) ")
+                sel6 = ask(f"You've selected {sel5}, is this correct? (y/n) ")
                 if sel6 not in yes_list:
                     print("Please choose again")
                     continue
@@ -371,7 +486,7 @@ while True:
         continue
     break
 
-time.sleep(1)
+pause(1)
 #####################################################################################################################
 #                                                   Storage                                                         #
 #####################################################################################################################
@@ -379,7 +494,7 @@ while True:
     try:
         print("Now, we will choose your desired storage options, to learn more about EBS specs, please visit this link: "
               "https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ebs-volume-types.html?")
-        time.sleep(1)
+        pause(1)
 
         """Select Storage"""
         """Select Volume Type"""
@@ -391,11 +506,11 @@ while True:
             try:
                 for key, value in volume_type_dict.items():
                     print(f"{key}. {value}")
-                volume_type_sel = int(input(f"Please select a volume type (1-{len(volume_type_dict)}), the default is 1. gp3: "))
+                volume_type_sel = int(ask(f"Please select a volume type (1-{len(volume_type_dict)}), the default is 1. gp3: "))
                 if len(volume_type_dict) <= volume_type_sel < 0:
                     print("This is not a valid volume type, please try again")
                 else:
-                    volume_type_confirm = input(f"You've selected {volume_type_dict[volume_type_sel]}, is this correct? (y/n): ")
+                    volume_type_confirm = ask(f"You've selected {volume_type_dict[volume_type_sel]}, is this correct? (y/n): ")
                     if volume_type_confirm not in yes_list:
                         print("Please choose again")
                     volume_type = volume_type_dict[volume_type_sel]
@@ -403,7 +518,7 @@ while True:
                 print("This is not a valid volume type, please try again")
 
         while True:
-            volume_size = input(f"Please enter the desired size of the root volume (between 8GB and 16TB): ").lower()
+            volume_size = ask(f"Please enter the desired size of the root volume (between 8GB and 16TB): ").lower()
             if "tb" in volume_size:
                 volume_size = volume_size.replace("tb", "").replace(" ", "").replace("-", "").replace(",", "")
                 volume_size = int(float(volume_size) * 1000 + 0.5)
@@ -425,7 +540,7 @@ while True:
                 print("This is not a valid volume size, please a value between 8 GB and 16,000 GB")
                 continue
 
-            volume_confirm = input(f"You've chosen {volume_size:,} GB. Is this correct? (y/n): ")
+            volume_confirm = ask(f"You've chosen {volume_size:,} GB. Is this correct? (y/n): ")
             if volume_confirm not in yes_list:
                 print("Please choose again")
                 continue
@@ -451,12 +566,12 @@ while True:
             max_iops = iops_options_dict[volume_type][1]
             while iops_confirm not in yes_list:
                 try:
-                    selected_iops = (input(f"Please select number of IOPS between {min_iops:,} and {max_iops:,}, the default is {selected_iops:,}: "))
+                    selected_iops = (ask(f"Please select number of IOPS between {min_iops:,} and {max_iops:,}, the default is {selected_iops:,}: "))
                     selected_iops = int(selected_iops.replace(" ", "").replace("-", "").replace(",", ""))
                     if selected_iops not in range(min_iops, max_iops+1):
                         print("This is not a valid number of IOPS, please try again")
                     else:
-                        iops_confirm = input(f"You've selected {selected_iops:,}, is this correct? (y/n): ")
+                        iops_confirm = ask(f"You've selected {selected_iops:,}, is this correct? (y/n): ")
                         if iops_confirm not in yes_list:
                             print("Please choose again")
                         iops = selected_iops
@@ -470,11 +585,11 @@ while True:
             throughput_confirm = 'no'
             while throughput_confirm not in yes_list:
                 try:
-                    selected_throughput = int(input(f"Please select a throughput value between 125 and 1000, the default is 125: "))
+                    selected_throughput = int(ask(f"Please select a throughput value between 125 and 1000, the default is 125: "))
                     if selected_throughput not in range(125, 1001):
                         print("This is not a valid throughput value, please try again")
                     else:
-                        throughput_confirm = input(f"You've selected {selected_throughput}, is this correct? (y/n): ")
+                        throughput_confirm = ask(f"You've selected {selected_throughput}, is this correct? (y/n): ")
                         if throughput_confirm not in yes_list:
                             print("Please choose again")
                         throughput = selected_throughput
@@ -483,7 +598,7 @@ while True:
 
         """Encryption"""
         selected_encryption = False
-        sel_encrypt = input(f"Would you like to encrypt this volume? The default is no. (y/n): ")
+        sel_encrypt = ask(f"Would you like to encrypt this volume? The default is no. (y/n): ")
         while True:
             if sel_encrypt not in yes_list:
                 selected_encryption = False
@@ -496,7 +611,7 @@ while True:
 
         """Delete Volume on Termination"""
         delete_on_term = True
-        delete_on_term_input = input(f"Would you like to delete this volume when the instance is deleted? The default is yes. (y/n): ")
+        delete_on_term_input = ask(f"Would you like to delete this volume when the instance is deleted? The default is yes. (y/n): ")
         while True:
             if delete_on_term_input not in yes_list:
                 delete_on_term = False
@@ -561,7 +676,7 @@ while True:
                   f"Volume encryption: {selected_encryption}\n"
                   f"Delete Volume with Instance: {delete_on_term}\n"
                   f"********************************************************************************************")
-            confirm_volume = input(f"Does this look correct? (y/n): ")
+            confirm_volume = ask(f"Does this look correct? (y/n): ")
             if confirm_volume not in yes_list:
                 print("Please choose your settings again")
                 break
@@ -571,7 +686,7 @@ while True:
     except Exception:
         continue
 
-time.sleep(1)
+pause(1)
 #####################################################################################################################
 #                                               Software Configurations                                             #
 #####################################################################################################################
@@ -698,10 +813,10 @@ while True:
                               8: 'Nginx', 9: 'Caddy', 10: 'Apache', 11: 'NodeJS', 12: 'Airflow'}
 
         print("Now we will choose your desired software options, this allows you to pre-install commonly used programs")
-        time.sleep(1)
+        pause(1)
         for i in software_choice:
             print(f'{i}. {software_choice[i]}')
-            time.sleep(.25)
+            pause(.25)
 
         print(f"Please review the software packages above, the default is Basic (#2)")
         software_sel = 2
@@ -709,11 +824,11 @@ while True:
         software_conf = 'no'
         while software_conf not in yes_list:
             try:
-                software_sel = int(input(f"Please select a software package (1-{len(software_choice)}): "))
+                software_sel = int(ask(f"Please select a software package (1-{len(software_choice)}): "))
                 if len(software_choice) <= software_sel <= 0:
                     print("This is not a valid selection, please try again")
                 else:
-                    software_conf = input(f"You've selected {software_choice[software_sel]}, is this correct? (y/n): ")
+                    software_conf = ask(f"You've selected {software_choice[software_sel]}, is this correct? (y/n): ")
                     if software_conf not in yes_list:
                         print("Please choose again")
                         continue
@@ -729,8 +844,8 @@ while True:
             print(f"Please review the available software packages:")
             for i in toppings.keys():
                 print(f'{toppings[i][0]}. {i}')
-                time.sleep(0.25)
-            toppings_selection = input(f"Please enter your desired software packages in a comma separated list (e.g. 1,2,3) or enter 'all' to install all packages: ")
+                pause(0.25)
+            toppings_selection = ask(f"Please enter your desired software packages in a comma separated list (e.g. 1,2,3) or enter 'all' to install all packages: ")
             if toppings_selection == 'all':
                 toppings_list = lst = list(range(1, len(toppings) + 1))
             else:
@@ -764,7 +879,7 @@ while True:
         continue
     break
 
-time.sleep(1)
+pause(1)
 ######################################################################################################################
 #                                                  Create Security Group                                             #
 ######################################################################################################################
@@ -772,17 +887,16 @@ while True:
     try:
         print("Now, we will setup the Secruity Group for your EC2 instance, to learn more about AWS Security Groups, please visit this link:"
               "https://docs.aws.amazon.com/vpc/latest/userguide/VPC_SecurityGroups.html")
-        time.sleep(1)
+        pause(1)
         """Get Existing Security Groups"""
-        spin = start_spinner(busy_text='Loading Security Group Settings...')
-        existing_security_groups = ec2_client.describe_security_groups()
-        existing_vpcs = ec2_client.describe_vpcs().get('Vpcs', [{}])[0]['VpcId']
-        spin.stop()
+        existing_security_groups = prefetched('describe_security_groups', 'Loading Security Group Settings...')
+        vpcs = prefetched('describe_vpcs', 'Loading Security Group Settings...')
+        existing_vpcs = vpcs.get('Vpcs', [{}])[0]['VpcId']
 
         sg_view_existing = 'y'
         sg_existing_list = []
         while sg_view_existing in yes_list:
-            sg_view_existing = input(f'Would you like to use an existing Security Group? (y/n): ')
+            sg_view_existing = ask(f'Would you like to use an existing Security Group? (y/n): ')
             if sg_view_existing in yes_list:
                 for i in existing_security_groups['SecurityGroups']:
                     sg_existing_list.append(i['GroupName'])
@@ -792,7 +906,7 @@ while True:
                     try:
                         for i in range(1, len(sg_existing_dict)+1):
                             print(f"{i}. {sg_existing_dict[i]}")
-                        sg_selection = input(f'Please enter a Security Group to use (1-{len(sg_existing_dict)}), or \'new\' to exit and create a new group: ')
+                        sg_selection = ask(f'Please enter a Security Group to use (1-{len(sg_existing_dict)}), or \'new\' to exit and create a new group: ')
                         if sg_selection in no_list:
                             sg_view_existing = 'no'
                             break
@@ -801,7 +915,7 @@ while True:
                             print("This is not a valid selection, please try again")
                             continue
                         selected_sg = sg_existing_dict[sg_selection]
-                        sg_confirm = input(f"You've selected {selected_sg}, is this correct? (y/n): ")
+                        sg_confirm = ask(f"You've selected {selected_sg}, is this correct? (y/n): ")
                         if sg_confirm in no_list:
                             print("Please try again")
                             continue
@@ -822,10 +936,10 @@ while True:
             """Create New Security Group"""
             ip_confirm = 'no'
             while ip_confirm not in yes_list:
-                external_ip = get_external_ip()
-                ip_confirm = input(f'Your external IP address is {external_ip}, does this look correct? (y/n): ')
+                external_ip = prefetched('external_ip', 'Getting your external IP address...')
+                ip_confirm = ask(f'Your external IP address is {external_ip}, does this look correct? (y/n): ')
                 if ip_confirm not in yes_list:
-                    external_ip = input("Please manually enter your IP address in the format of 0.0.0.0: ")
+                    external_ip = ask("Please manually enter your IP address in the format of 0.0.0.0: ")
                     external_ip_check = list(
                         external_ip.replace(" ", "").replace(".", "").replace("/", "").replace(":", ""))
                     if len(external_ip_check) != 4:
@@ -880,11 +994,11 @@ while True:
             base_confirm = 'no'
             while base_confirm not in yes_list:
                 try:
-                    choose_base_rules = int(input("Please select the desired set of base rules (1 or 2): "))
+                    choose_base_rules = int(ask("Please select the desired set of base rules (1 or 2): "))
                     if choose_base_rules not in range(1, len(rules)+1):
                         print("This is not a valid selection, please try again")
                         continue
-                    base_confirm = input(f"You've selected '{rules[choose_base_rules][0]}', is this correct? (y/n): ")
+                    base_confirm = ask(f"You've selected '{rules[choose_base_rules][0]}', is this correct? (y/n): ")
                     security_group_rules.append(rules[choose_base_rules][1])
                 except Exception:
                     print("This is not a valid selection, please try again")
@@ -901,16 +1015,16 @@ while True:
 
             add_another_rule = 'yes'
             while add_another_rule not in no_list:
-                add_another_rule = input(f'Would you like to manually add another rule? (y/n): ')
+                add_another_rule = ask(f'Would you like to manually add another rule? (y/n): ')
                 if add_another_rule in yes_list:
-                    custom_ip = input("Please manually enter the IP address in the format of 0.0.0.0: ")
+                    custom_ip = ask("Please manually enter the IP address in the format of 0.0.0.0: ")
                     add_ip_check = list(custom_ip.replace(" ", "").replace(".", "").replace("/", "").replace(":", ""))
                     if len(add_ip_check) != 4:
                         print(add_ip_check)
                         print(f"You've entered an incorrect IP address '{custom_ip}', please try again")
                         continue
                     try:
-                        port = int(input("Please manually enter the port number:"))
+                        port = int(ask("Please manually enter the port number:"))
                     except Exception:
                         print("That's not a valid port, please start over")
                         continue
@@ -922,7 +1036,7 @@ while True:
                         print("We can automatically allow TradingView Webhooks to connect to your instance. "
                               "Learn more about TradingView Webhooks here: "
                               "https://www.tradingview.com/support/solutions/43000529348-about-webhooks/")
-                        add_tv = input(f'Would you like to permission TradingView IPs to allow Webhooks? (y/n): ')
+                        add_tv = ask(f'Would you like to permission TradingView IPs to allow Webhooks? (y/n): ')
                         if add_tv in yes_list:
                             tv_ips = ['52.89.214.238', '34.212.75.30', '54.218.53.128', '52.32.178.7']
                             ports = [80, 443]
@@ -935,8 +1049,7 @@ while True:
             """Create Security Group"""
             spin = start_spinner(busy_text='Creating Security Group...')
             description = f'{security_group_name} created by the MML Auto-EC2 generator on {datetime.now()}'
-            response = ec2_client.describe_vpcs()
-            vpc_id = response.get('Vpcs', [{}])[0]['VpcId']
+            vpc_id = existing_vpcs
             try:
                 """Create Security Group"""
                 response = ec2_client.create_security_group(GroupName=security_group_name,
@@ -952,6 +1065,7 @@ while True:
                     IpPermissions=security_group_rules,
                     DryRun=dry_run
                 )
+                metadata_cache.invalidate(account, selected_region, 'describe_security_groups')
 
             except Exception as e:
                 print(e)
@@ -959,15 +1073,15 @@ while True:
             stop_spinner(spin, done_text=f'Security Group Created: {security_group_name}')
             break
 
-        time.sleep(1)
+        pause(1)
 
         """Create Key Pair"""
         key_pair_location = 'keypair.pem'
         confirm_key = 'n'
         while confirm_key not in yes_list:
-            create_key = input(f"Do you need a new keypair.pem? If this is your first instance choose 'yes' (y/n): ")
+            create_key = ask(f"Do you need a new keypair.pem? If this is your first instance choose 'yes' (y/n): ")
             if create_key in yes_list:
-                confirm_key = input(f"You've selected to create a new keypair, is this correct? (y/n): ")
+                confirm_key = ask(f"You've selected to create a new keypair, is this correct? (y/n): ")
                 if confirm_key in yes_list:
                     spin = start_spinner(busy_text='Creating Key Pair')
                     key_name = f'keypair_{secrets.token_hex(2)}'
@@ -985,7 +1099,7 @@ while True:
                     spin.stop()
 
             if create_key in no_list:
-                confirm_key = input(f"You've selected to not create a new keypair, is this correct? (y/n): ")
+                confirm_key = ask(f"You've selected to not create a new keypair, is this correct? (y/n): ")
                 if confirm_key in yes_list:
                     break
                 else:
@@ -994,14 +1108,14 @@ while True:
         continue
     break
 
-time.sleep(1)
+pause(1)
 ######################################################################################################################
 #                                               Create Instance                                                      #
 ######################################################################################################################
 print(f"We will now create your instance")
-input(f"Press any key to continue")
+ask(f"Press any key to continue")
 
-time.sleep(1)
+pause(1)
 """Create EC2 Instance"""
 spin = start_spinner(busy_text='Creating instance...')
 response = ec2_client.run_instances(
@@ -1030,33 +1144,22 @@ stop_spinner(spin, done_text=f'Instance created, ID: {instance_id} ')
 ######################################################################################################################
 #                                                     Elastic IP                                                     #
 ######################################################################################################################
-"""Create Elastic IP"""
-spin = start_spinner(busy_text='Creating Elastic IP address...')
-
-allocate_elip = ec2_client.allocate_address(
-    # Domain='vpc' or 'standard',
-    Domain='vpc',
-    # Address='string',
-    # PublicIpv4Pool='string',
-    # NetworkBorderGroup='string',
-    # CustomerOwnedIpv4Pool='string',
-    DryRun=dry_run,
-)
-public_ip = allocate_elip['PublicIp']
-stop_spinner(spin, done_text=f'Elastic IP created, IP: {public_ip}')
+"""Create Elastic IP, unless the pool had a free one"""
+address = prefetched('elastic_ip', 'Looking for a free Elastic IP address...')
+if address is None:
+    spin = start_spinner(busy_text='Creating Elastic IP address...', t=0)
+    address = address_pool.allocate()
+    stop_spinner(spin, done_text=f"Elastic IP {address['PublicIp']} created")
+public_ip = address['PublicIp']
 
 """Associate Elastic IP"""
 spin = start_spinner(busy_text=f'Associating Elastic IP with instance {instance_id}')
-time.sleep(30)
-associate_elip = ec2_client.associate_address(
-    InstanceId=instance_id,
-    PublicIp=public_ip,
-    # AllocationId=None,
-    # NetworkInterfaceId=None,
-    # PrivateIpAddress=None,
-    AllowReassociation=False,
-    DryRun=dry_run
-)
+"""The address can only be associated once the instance is running, the spinner shows each state as it's seen"""
+poller = InstancePoller(ec2_client, on_change=lambda changed_id, previous, state: setattr(
+    spin, 'text', f'Associating Elastic IP with instance {changed_id} (instance is {state})'))
+poller.wait_for_state([instance_id], 'running')
+address_pool.associate(instance_id, address)
+poller.wait([instance_id], has_public_ips({instance_id: public_ip}))
 spin.stop()
 stop_spinner(spin, done_text=f'Elastic IP {public_ip} associated with instance {instance_id}')
 
@@ -1074,7 +1177,7 @@ with open(f"{file_name}", "w") as readme_file:
        f"Instance URL: https://{selected_region}.console.aws.amazon.com/ec2/v2/home?region={selected_region}#InstanceDetails:instanceId={instance_id} \n"
        f"Connect to your instance with the following command: ssh -i {key_pair_location} ubuntu@{public_ip} \n"
        f"Start time: {started}, total run time: {run_time} minutes \n"
-       f"Image name: {image_id}, image ID: {image_id} \n"
+       f"Image ID: {image_id} \n"
        f"Region: {selected_region} \n"
        f"Instance type: {selected_type} \n"
        f"Subnet: {selected_subnet} \n"
@@ -1093,14 +1196,14 @@ stop_spinner(spin, done_text="Documentation created")
 #                                                 Exit Message                                                       #
 ######################################################################################################################
 print("Success! Your instance has been created successfully!")
-time.sleep(1)
+pause(1)
 print(f"You can view the summary of this MML Auto-EC2 Generator session here: {readme_location}")
-time.sleep(1)
+pause(1)
 print(f"You can view your instance online here: https://us-east-2.console.aws.amazon.com/ec2/v2/home?region={selected_region}#InstanceDetails:instanceId={instance_id}")
-time.sleep(1)
+pause(1)
 print(f"You can connect to your instance via SSH with the following command: ssh -i '{key_pair_location}' ubuntu@{public_ip}")
-time.sleep(1)
+pause(1)
 print("Thank you for using the MML Auto-EC2 Generator! We hope you liked this MML open source offering, "
       "if you have any questions or just want to chat - join us on discord: https://discord.gg/jjDcZcqXWy!")
-time.sleep(1)
+pause(1)
 print("To support our development, please consider subscribing at https://marketmakerlite.com/subscribe")
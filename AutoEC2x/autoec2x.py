@@ -0,0 +1,1399 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import time
+process_start = time.perf_counter()
+import os
+import sys
+"""autoec2_common (shared with AutoEC2) is in the repository root"""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import boto3
+from botocore import exceptions as bc
+from concurrent.futures import ThreadPoolExecutor, wait
+from autoec2_common.cache import MetadataCache, credentials_fingerprint
+from autoec2_common.clients import ClientFactory, client_config
+from rules import compact_rules, count_rules
+from images import ImageRegistry
+from autoec2_common.poller import InstancePoller, has_public_ips
+from autoec2_common.addresses import AddressPool
+from timeline import ApiRecorder, Timeline
+from autoec2_common.base_images import find_base_image, instance_architecture
+from userdata import (STEPS_DIRECTORY, check_userdata_size, compile_userdata, encode_userdata, install_hash,
+                      parse_toppings, userdata_size)
+import threading
+import weakref
+from datetime import datetime
+import secrets
+import traceback
+import re
+import hashlib
+import base64
+import json
+import shutil
+import_seconds = time.perf_counter() - process_start
+######################################################################################################################
+#                                                     Settings                                                       #
+######################################################################################################################
+ready_marker = 'MML-AUTOEC2-READY'
+failed_marker = 'MML-AUTOEC2-FAILED'
+fingerprint_tag = 'mml-autoec2x:rules-fingerprint'
+warm_pool_tag = 'mml-autoec2x:warm-pool'
+"""Timeline phase of each prefetched lookup"""
+prefetch_phases = {
+    'describe_regions': 'regions',
+    'describe_instance_types': 'instance types',
+    'catalog': 'instance types',
+    'describe_subnets': 'subnets',
+    'describe_security_groups': 'security groups',
+    'describe_vpcs': 'vpcs',
+    'base_image': 'base image',
+    'external_ip': 'external ip',
+    'address_pool': 'elastic ip pool',
+}
+
+"""Per-instance settings, these can also be overridden by each fleet entry (names match config.py)"""
+INSTANCE_DEFAULTS = {
+    'instance_type': 't2.micro',
+    'instance_requirements': None,
+    'instance_count': 1,
+    'subnet_zone': 'a',
+    'use_elastic_ip': False,
+    'spot': False,
+    'volume_type': 'gp3',
+    'volume_size': '8 GB',
+    'volume_iops': 3000,
+    'volume_throughput': 125,
+    'delete_volume_on_termination': True,
+    'encrypt_volume': False,
+    'software_selections': None,
+    'custom_userdata': None,
+    'use_existing_security_group': False,
+    'existing_security_group_name': None,
+    'strict_or_relaxed': 'strict',
+    'add_trading_view_ips': False,
+    'add_more_rules': False,
+    'custom_rule_list': [],
+    'create_keypair': False,
+    'existing_key_name': 'keypair',
+    'create_readme': False,
+}
+
+"""Settings that apply to the whole provisioning run"""
+RUN_DEFAULTS = {
+    'dry_run': False,
+    'use_default_region': True,
+    'selected_region': None,
+    'regions': None,
+    'fleet': None,
+    'fleet_max_workers': 8,
+    'wait_until_ready': True,
+    'ready_timeout': 1200,
+    'ready_poll_interval': 5,
+    'ready_poll_max_interval': 30,
+    'state_poll_interval': 1,
+    'state_poll_max_interval': 15,
+    'state_timeout': 600,
+    'bake_image': False,
+    'use_baked_images': True,
+    'elastic_ip_pool': 'default',
+    'elastic_ip_pool_size': 0,
+    'warm_pool_size': 0,
+    'warm_pool_idle': 'stop',
+    'warm_pool_max_age': 7 * 24 * 3600,
+    'warm_pool_match_ignore': [],
+    'fill_warm_pool': False,
+    'spot_diversity': 5,
+    'spot_on_demand_fallback': True,
+    'timeline_path': None,
+    'max_pool_connections': None,
+    'tcp_keepalive': True,
+    'retry_mode': 'standard',
+    'max_attempts': 5,
+    'use_cache': True,
+    'cache_path': None,
+    'cache_ttl': {},
+}
+
+"""Clients and the account are kept per session, so repeated provision() calls reuse warm connections"""
+_session_state = weakref.WeakKeyDictionary()
+_default_sessions = []
+_caches = {}
+_state_lock = threading.Lock()
+_warm_pool_refills = []
+startup = {'import_seconds': round(import_seconds, 3), 'first_api_call_seconds': None}
+######################################################################################################################
+#                                                       Functions                                                    #
+######################################################################################################################
+
+
+def ec2_instance_type_records(ec2_client):
+    """Yield the full record of all available EC2 instance types in region <region_name>"""
+    describe_args = {}
+    while True:
+        describe_result = ec2_client.describe_instance_types(**describe_args)
+        yield from describe_result['InstanceTypes']
+        if 'NextToken' not in describe_result:
+            break
+        describe_args['NextToken'] = describe_result['NextToken']
+    return None
+
+
+def ec2_instance_types(ec2_client):
+    """Yield all available EC2 instance types in region <region_name>"""
+    yield from [i['InstanceType'] for i in ec2_instance_type_records(ec2_client)]
+    return None
+
+
+def create_userdata(confirmed_software, custom_userdata, baked=False):
+    """Compile the userdata for the selected toppings, returns the userdata and its size"""
+    parts = compile_userdata(confirmed_software, custom_userdata, ready_marker, baked=baked,
+                             failed_marker=failed_marker)
+    user_data = encode_userdata(parts)
+    size = userdata_size(parts, user_data)
+    check_userdata_size(size)
+    return user_data, size
+
+
+def strip_metadata(response):
+    return {key: value for key, value in response.items() if key != 'ResponseMetadata'}
+
+
+def session_state(session):
+    with _state_lock:
+        if session not in _session_state:
+            session.events.register('before-send', record_first_api_call)
+            api_recorder = ApiRecorder()
+            api_recorder.register(session.events)
+            _session_state[session] = {'client_factories': {}, 'account': None, 'lock': threading.Lock(),
+                                       'api_recorder': api_recorder}
+        return _session_state[session]
+
+
+def get_client_factory(session, settings):
+    """Return the session's client factory for these connection settings, creating it on first use"""
+    """Every group worker in a region shares that region's client, so the pool is sized to the worker count"""
+    max_pool_connections = settings['max_pool_connections'] or max(10, settings['fleet_max_workers'])
+    config_key = (max_pool_connections, settings['tcp_keepalive'], settings['retry_mode'], settings['max_attempts'])
+    state = session_state(session)
+    with state['lock']:
+        if config_key not in state['client_factories']:
+            state['client_factories'][config_key] = ClientFactory(session, client_config(*config_key))
+        return state['client_factories'][config_key]
+
+
+def default_session():
+    """Reused by every provision() call that doesn't pass its own session"""
+    with _state_lock:
+        if not _default_sessions:
+            _default_sessions.append(boto3.session.Session())
+        return _default_sessions[0]
+
+
+def get_cache(settings, refresh=False):
+    """Reuse one metadata cache (and its SQLite connection) per cache location"""
+    cache_key = (settings['cache_path'], settings['use_cache'], refresh,
+                 json.dumps(settings['cache_ttl'], sort_keys=True))
+    with _state_lock:
+        if cache_key not in _caches:
+            _caches[cache_key] = MetadataCache(path=settings['cache_path'], refresh=refresh,
+                                               enabled=settings['use_cache'], ttls=settings['cache_ttl'])
+        return _caches[cache_key]
+
+
+def get_identity(run):
+    """Return the caller identity for the session's credentials, from the cache when possible"""
+    credentials = run['session'].get_credentials()
+    if credentials is None:
+        raise bc.NoCredentialsError()
+    return run['cache'].fetch(credentials_fingerprint(credentials), '', 'get_caller_identity',
+                              lambda: strip_metadata(run['clients'].client('sts').get_caller_identity()))
+
+
+def get_account(run):
+    """The account only keys the metadata cache, so it is looked up the first time the cache is used"""
+    state = session_state(run['session'])
+    with state['lock']:
+        if state['account'] is None:
+            state['account'] = get_identity(run)['Account']
+    return state['account']
+
+
+def cached_call(run, region, call, loader):
+    """Return the result of <call> in <region> from the metadata cache, calling <loader> on a miss"""
+    if not run['cache'].enabled:
+        return loader()
+    return run['cache'].fetch(get_account(run), region, call, loader)
+
+
+def get_ec2_client(run, region):
+    """Create the region's EC2 client on first use and reuse it afterwards"""
+    return run['clients'].client('ec2', region)
+
+
+def get_address_pool(run, region):
+    """Every group in a region hands out addresses from the same pool"""
+    with run['lock']:
+        if region not in run['address_pools']:
+            run['address_pools'][region] = AddressPool(get_ec2_client(run, region), run['settings']['elastic_ip_pool'],
+                                                       run['settings']['dry_run'])
+        return run['address_pools'][region]
+
+
+def phase(context, name, prepared=None):
+    """Time a step in the run's timeline, labelled with the region and, once prepared, the group"""
+    labels = {'region': context['region']}
+    if prepared is not None:
+        labels['group'] = prepared.get('group')
+    return context['run']['timeline'].span(name, **labels)
+
+
+def record_first_api_call(**kwargs):
+    if startup['first_api_call_seconds'] is None:
+        startup['first_api_call_seconds'] = round(time.perf_counter() - process_start, 3)
+    return None
+
+
+def get_external_ip():
+    import urllib.request
+    external_ip = urllib.request.urlopen('http://ident.me').read().decode('utf8')
+    return external_ip
+
+
+def custom_sg_rule(port, custom_ip):
+    custom_rule = {
+        'IpProtocol': 'tcp',
+        'FromPort': port,
+        'ToPort': port,
+        'IpRanges': [{'CidrIp': f'{custom_ip}/32'}]
+    }
+    return custom_rule
+
+
+def customtv_sg_rule(port, custom_ip):
+    custom_rule = {
+        'IpProtocol': 'tcp',
+        'FromPort': port,
+        'ToPort': port,
+        'IpRanges': [{'CidrIp': f'{custom_ip}/32'}]
+    }
+    return custom_rule
+
+
+def spec_from_config(config):
+    """Collect the provisioning settings from a config.py style module"""
+    return {key: getattr(config, key) for key in list(INSTANCE_DEFAULTS) + list(RUN_DEFAULTS) if hasattr(config, key)}
+
+
+def build_spec(settings, overrides=None):
+    """Merge a fleet entry <overrides> over the per-instance settings"""
+    spec = {key: settings[key] for key in INSTANCE_DEFAULTS}
+    if overrides is not None:
+        unknown = [key for key in overrides if key not in INSTANCE_DEFAULTS]
+        if unknown:
+            raise ValueError(f"Invalid fleet settings: {unknown}")
+        spec.update(overrides)
+    return spec
+
+
+def parse_volume_size(volume_size):
+    volume_size = volume_size.lower()
+    if "tb" in volume_size:
+        volume_size = volume_size.replace("tb", "").replace(" ", "").replace("-", "").replace(",", "")
+        volume_size = int(float(volume_size) * 1000 + 0.5)
+    elif "tib" in volume_size:
+        volume_size = volume_size.replace("tib", "").replace(" ", "").replace("-", "").replace(
+            ",", "")
+        volume_size = int(float(volume_size) * 1024 + 0.5)
+    elif "gb" in volume_size:
+        volume_size = volume_size.replace("gb", "").replace(" ", "").replace("-", "").replace(",", "")
+        volume_size = int(float(volume_size) + 0.5)
+    elif "gib" in volume_size:
+        volume_size = volume_size.replace("gib", "").replace(" ", "").replace("-", "").replace(",", "")
+        volume_size = int(float(volume_size) * 1.07 + 0.5)
+    else:
+        volume_size = volume_size.replace(" ", "").replace("-", "").replace(",", "")
+        volume_size = int(float(volume_size) + 0.5)
+
+    if volume_size < 8 or volume_size > 16000:
+        raise ValueError("This is not a valid volume size, please a value between 8 GB and 16TB")
+    return volume_size
+
+
+def build_block_device_mappings(spec):
+    """Set Block Device Mappings for EC2 Launch Template"""
+    volume_type = spec['volume_type']
+    volume_size = parse_volume_size(spec['volume_size'])
+
+    if volume_type in ['gp3', 'io1', 'io2']:
+        """[GP3, io1, io2 ONLY] Select IOPS"""
+        iops_options_dict = {'gp3': [3000, 16000], 'io1': [100, 5000], 'io2': [100, 100000]}
+        min_iops = iops_options_dict[volume_type][0]
+        max_iops = iops_options_dict[volume_type][1]
+        if spec['volume_iops'] not in range(min_iops, max_iops+1):
+            raise ValueError("Not a valid IOPS value")
+
+    ebs = {
+        'Encrypted': spec['encrypt_volume'],
+        'DeleteOnTermination': spec['delete_volume_on_termination'],
+        'VolumeSize': volume_size,
+        'VolumeType': volume_type
+    }
+    if volume_type == 'gp3':
+        """[GP3 ONLY] Select Throughput"""
+        if spec['volume_throughput'] not in range(125, 1001):
+            raise ValueError("Not a valid throughput")
+        ebs['Throughput'] = spec['volume_throughput']
+        ebs['Iops'] = spec['volume_iops']
+    elif volume_type in ['io1', 'io2']:
+        ebs['Iops'] = spec['volume_iops']
+    elif volume_type != 'gp2':
+        raise ValueError("Not a valid Volume Type")
+
+    block_device_mappings = [{
+        'DeviceName': '/dev/sda1',
+        'Ebs': ebs,
+    }]
+    return block_device_mappings
+
+
+def catalog_directory(metadata_cache):
+    """The catalogs are saved next to the metadata cache, in <account>/<region> below this directory"""
+    return os.path.join(os.path.dirname(metadata_cache.path), 'catalog')
+
+
+def clear_catalogs(metadata_cache):
+    """Delete every saved instance type catalog, the catalog's part of clearing the metadata cache"""
+    if metadata_cache.enabled:
+        shutil.rmtree(catalog_directory(metadata_cache), ignore_errors=True)
+    return None
+
+
+def load_catalog(run, ec2_client, region):
+    """Load the region's instance type catalog, rebuilding it from describe_instance_types when stale"""
+    from catalog import InstanceTypeCatalog
+    metadata_cache = run['cache']
+    instance_catalog = None
+    if metadata_cache.enabled:
+        directory = os.path.join(catalog_directory(metadata_cache), get_account(run), region)
+        if not metadata_cache.refresh:
+            instance_catalog = InstanceTypeCatalog.load(directory,
+                                                        max_age=metadata_cache.ttls['describe_instance_types'])
+    if instance_catalog is None:
+        instance_catalog = InstanceTypeCatalog.build(ec2_instance_type_records(ec2_client))
+        if metadata_cache.enabled:
+            instance_catalog.save(directory)
+    return instance_catalog
+
+
+class Prefetch:
+    """Runs independent lookups concurrently, a lookup requested more than once is only run once"""
+
+    def __init__(self, executor, timeline=None):
+        self._executor = executor
+        self._timeline = timeline
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, loader, *args):
+        with self._lock:
+            if key not in self._futures:
+                self._futures[key] = self._executor.submit(self._load, key, loader, *args)
+            return self._futures[key]
+
+    def _load(self, key, loader, *args):
+        if self._timeline is None:
+            return loader(*args)
+        """Keys are either a name or (region, name, ...)"""
+        region, name = (key[0], key[1]) if isinstance(key, tuple) else (None, key)
+        with self._timeline.span(prefetch_phases.get(name, name), region=region):
+            return loader(*args)
+
+    def result(self, key):
+        """Wait for the lookup submitted under <key> and return its result, or raise its exception"""
+        return self._futures[key].result()
+
+
+def prefetch_region(prefetch, run, region, need_catalog=False):
+    """Start every region-wide lookup shared by the instances launched in <region>"""
+    ec2_client = get_ec2_client(run, region)
+    prefetch.submit((region, 'describe_subnets'), cached_call, run, region, 'describe_subnets',
+                    lambda: strip_metadata(ec2_client.describe_subnets()))
+    """The catalog holds every instance type, so the plain name list is only fetched without it"""
+    if need_catalog:
+        prefetch.submit((region, 'catalog'), load_catalog, run, ec2_client, region)
+    else:
+        prefetch.submit((region, 'describe_instance_types'), cached_call, run, region, 'describe_instance_types',
+                        lambda: list(ec2_instance_types(ec2_client)))
+    """Stored as the response (like AutoEC2 does), both tools read the same cache entries"""
+    prefetch.submit((region, 'describe_security_groups'), cached_call, run, region, 'describe_security_groups',
+                    lambda: strip_metadata(ec2_client.describe_security_groups()))
+    prefetch.submit((region, 'describe_vpcs'), cached_call, run, region, 'describe_vpcs',
+                    lambda: strip_metadata(ec2_client.describe_vpcs()))
+    """Most instance types are x86_64, other architectures are resolved when an instance needs them"""
+    prefetch_base_image(prefetch, run, region, 'x86_64')
+    return None
+
+
+def prefetch_base_image(prefetch, run, region, architecture):
+    return prefetch.submit((region, 'base_image', architecture), cached_call, run, region, f'base_image:{architecture}',
+                           lambda: find_base_image(run['clients'], region, architecture))
+
+
+def discover_region(prefetch, run, region, need_catalog=False):
+    """Collect the region's prefetched lookups into the context shared by its instances"""
+    sn_all = prefetch.result((region, 'describe_subnets'))
+    subnet_dict = {}
+    for i in range(0, len(sn_all['Subnets'])):
+        subnet_dict[sn_all['Subnets'][i]['AvailabilityZone']] = sn_all['Subnets'][i]['SubnetId']
+
+    if need_catalog:
+        instance_catalog = prefetch.result((region, 'catalog'))
+        instance_types = instance_catalog
+    else:
+        instance_catalog = None
+        instance_types = set(prefetch.result((region, 'describe_instance_types')))
+
+    context = {
+        'run': run,
+        'prefetch': prefetch,
+        'region': region,
+        'ec2_client': get_ec2_client(run, region),
+        'poller': InstancePoller(get_ec2_client(run, region), interval=run['settings']['state_poll_interval'],
+                                 max_interval=run['settings']['state_poll_max_interval']),
+        'instance_types': instance_types,
+        'catalog': instance_catalog,
+        'subnets': subnet_dict,
+        'security_groups': prefetch.result((region, 'describe_security_groups'))['SecurityGroups'],
+        'vpc_id': prefetch.result((region, 'describe_vpcs')).get('Vpcs', [{}])[0]['VpcId'],
+    }
+    return context
+
+
+def group_specs(specs):
+    """Merge identical specs so each group can be launched with a single run_instances call"""
+    groups = {}
+    for index, spec in enumerate(specs):
+        launch_settings = {key: value for key, value in spec.items() if key != 'instance_count'}
+        group_key = json.dumps(launch_settings, sort_keys=True, default=str)
+        if group_key not in groups:
+            groups[group_key] = {'spec': dict(spec, instance_count=0), 'fleet_indexes': []}
+        groups[group_key]['spec']['instance_count'] += spec['instance_count']
+        groups[group_key]['fleet_indexes'].append(index)
+    return list(groups.values())
+
+
+def get_architecture(context, instance_type):
+    if context['catalog'] is not None:
+        return instance_architecture(context['catalog'].architectures(instance_type))
+    ec2_client = context['ec2_client']
+    return cached_call(context['run'], context['region'], f'instance_architecture:{instance_type}',
+                       lambda: instance_architecture(ec2_client.describe_instance_types(
+                           InstanceTypes=[instance_type])['InstanceTypes'][0]['ProcessorInfo']['SupportedArchitectures']))
+
+
+def find_baked_image(context, base_image_id, software_hash):
+    """Return the image baked earlier from <base_image_id> with the same install user data, or None"""
+    run = context['run']
+    baked_image_id = run['images'].get(context['region'], base_image_id, software_hash)
+    if baked_image_id is None:
+        return None
+    """The image may have been deregistered since it was baked"""
+    images = context['ec2_client'].describe_images(
+        Owners=['self'], Filters=[{'Name': 'image-id', 'Values': [baked_image_id]}])['Images']
+    if not images or images[0]['State'] != 'available':
+        run['images'].remove(context['region'], base_image_id, software_hash)
+        return None
+    return baked_image_id
+
+
+def prepare_instance(spec, context):
+    """Validate <spec> against the region before anything is created"""
+    settings = context['run']['settings']
+    if settings['bake_image']:
+        """One instance is enough to bake the image"""
+        spec = dict(spec, instance_count=1)
+    if not isinstance(spec['instance_count'], int) or spec['instance_count'] < 1:
+        raise ValueError("Invalid Instance Count")
+    if settings['warm_pool_idle'] not in ('stop', 'hibernate'):
+        raise ValueError("Invalid Warm Pool Idle Policy")
+    if settings['fill_warm_pool'] and settings['warm_pool_idle'] == 'hibernate' and not spec['encrypt_volume']:
+        """Hibernation saves the memory to the root volume, which AWS requires to be encrypted"""
+        raise ValueError("Hibernated warm pool instances need an encrypted volume (encrypt_volume = True)")
+
+    if spec['instance_requirements']:
+        matches = context['catalog'].select(spec['instance_requirements'])
+        if not matches:
+            raise ValueError("No instance type meets the instance requirements")
+        selected_type = matches[0]
+    elif spec['instance_type'] in context['instance_types']:
+        selected_type = spec['instance_type']
+    else:
+        raise ValueError("Invalid Instance Type")
+
+    """The base image differs per region and architecture, resolve it before anything is created"""
+    architecture = get_architecture(context, selected_type)
+    base_image_id = prefetch_base_image(context['prefetch'], context['run'], context['region'], architecture).result()
+
+    spot_offers = None
+    if spec['spot']:
+        if settings['fill_warm_pool'] or settings['warm_pool_size']:
+            """Checked before anything is launched, otherwise the background refill would fail after the run"""
+            raise ValueError("Spot instances can't be stopped, so they can't be kept in a warm pool "
+                             "(set warm_pool_size = 0)")
+        """The zone comes from the spot prices instead of subnet_zone"""
+        selected_subnet, spot_offers = plan_spot_instances(context, spec, selected_type, architecture)
+    else:
+        selected_subnet = context['region'] + spec['subnet_zone']
+        if selected_subnet not in context['subnets']:
+            raise ValueError("Invalid Subnet Zone")
+
+    with phase(context, 'storage'):
+        block_device_mappings = build_block_device_mappings(spec)
+
+    confirmed_software = parse_toppings(spec['software_selections'])
+    software_hash = install_hash(confirmed_software)
+    baked_image_id = None
+    if settings['use_baked_images'] and not settings['bake_image']:
+        baked_image_id = find_baked_image(context, base_image_id, software_hash)
+    user_data, user_data_size = create_userdata(confirmed_software, spec['custom_userdata'],
+                                                baked=baked_image_id is not None)
+    prepared = {
+        'spec': spec,
+        'base_image_id': base_image_id,
+        'image_id': baked_image_id or base_image_id,
+        'baked': baked_image_id is not None,
+        'install_hash': software_hash,
+        'selected_type': selected_type,
+        'selected_subnet': selected_subnet,
+        'selected_subnetid': context['subnets'][selected_subnet],
+        'block_device_mappings': block_device_mappings,
+        'spot_offers': spot_offers,
+        'user_data': user_data,
+        'user_data_size': user_data_size,
+        'confirmed_software': confirmed_software,
+    }
+    return prepared
+
+
+def plan_spot_instances(context, spec, selected_type, architecture):
+    """Choose the zone and the diversified instance types for a spot group from the region's current spot prices"""
+    from spot import plan_spot_fleet, spot_prices
+    catalog = context['catalog']
+    settings = context['run']['settings']
+    if spec['instance_requirements']:
+        requirements = dict(spec['instance_requirements'])
+    else:
+        """Types at least as large as instance_type, and at most twice its size"""
+        described = catalog.describe(selected_type)
+        requirements = {'min_vcpus': described['vcpus'], 'max_vcpus': 2 * described['vcpus'],
+                        'min_memory_gib': described['memory_mib'] / 1024,
+                        'max_memory_gib': 2 * described['memory_mib'] / 1024}
+    """Every type must run the image, and a few times more candidates than needed lets the prices decide"""
+    requirements['architecture'] = architecture
+    candidates = catalog.select(requirements, count=3 * settings['spot_diversity'])
+    candidates = list(dict.fromkeys([selected_type] + candidates))
+    instance_types, zones, prices = spot_prices(context['ec2_client'], candidates, set(context['subnets']))
+    return plan_spot_fleet(catalog, instance_types, zones, prices, settings['spot_diversity'], candidates)
+
+
+def build_security_group_rules(spec, confirmed_software, external_ip):
+    security_group_rules = []
+    relaxed = {
+        'IpProtocol': '-1',
+        'FromPort': -1,
+        'ToPort': -1,
+        'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
+    }
+    strict = {
+        'IpProtocol': '-1',
+        'FromPort': -1,
+        'ToPort': -1,
+        'IpRanges': [{'CidrIp': f'{external_ip}/32'}]
+    }
+    psql_rule = {
+        'IpProtocol': 'tcp',
+        'FromPort': 5432,
+        'ToPort': 5432,
+        'IpRanges': [{'CidrIp': '0.0.0.0/32'}]
+    }
+    mysql_rule = {
+        'IpProtocol': 'tcp',
+        'FromPort': 3306,
+        'ToPort': 3306,
+        'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
+    }
+    mongodb_rule = {
+        'IpProtocol': 'tcp',
+        'FromPort': 27017,
+        'ToPort': 27017,
+        'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
+    }
+
+    rules = {1: ["Relaxed", relaxed, 'Allows all connections (0.0.0.0)'],
+             2: ["Strict", strict, f'Allows connections only from your IP ({external_ip})']}
+    software_rules = {'Postgres': psql_rule, 'MongoDB': mongodb_rule, 'MySQL': mysql_rule}
+
+    try:
+        choose_base_rules = spec['strict_or_relaxed'].lower()
+        if choose_base_rules == 'relaxed':
+            security_group_rules.append(rules[1][1])
+        elif choose_base_rules == 'strict':
+            security_group_rules.append(rules[2][1])
+        else:
+            raise ValueError('Not a valid base rule selection')
+    except Exception:
+        raise ValueError('Not a valid base rule selection')
+
+    for i in confirmed_software:
+        try:
+            security_group_rules.append(software_rules[i])
+        except Exception:
+            security_group_rules = security_group_rules
+
+    if spec['add_more_rules']:
+        try:
+            for i in spec['custom_rule_list']:
+                custom_ip = i[0]
+                port = i[1]
+                security_group_rules.append(custom_sg_rule(port, custom_ip))
+        except Exception:
+            print(traceback.format_exc())
+            raise ValueError("Invalid Custom Security Group Rules")
+
+    if spec['add_trading_view_ips']:
+        tv_ips = ['52.89.214.238', '34.212.75.30', '54.218.53.128', '52.32.178.7']
+        ports = [80, 443]
+        for port in ports:
+            for ip in tv_ips:
+                security_group_rules.append(customtv_sg_rule(port, ip))
+    return security_group_rules
+
+
+def rules_fingerprint(security_group_rules):
+    """Hash the rule set independently of rule and CIDR order, so equal rule sets share one group"""
+    permissions = sorted({(rule['IpProtocol'], rule['FromPort'], rule['ToPort'], ip_range['CidrIp'])
+                          for rule in security_group_rules for ip_range in rule['IpRanges']})
+    return hashlib.sha256(json.dumps(permissions).encode('utf-8')).hexdigest()[:16]
+
+
+def find_security_group(ec2_client, vpc_id, fingerprint):
+    """Return the ID of a group created earlier with the same rules in <vpc_id>, or None"""
+    matching_groups = ec2_client.describe_security_groups(
+        Filters=[{'Name': f'tag:{fingerprint_tag}', 'Values': [fingerprint]},
+                 {'Name': 'vpc-id', 'Values': [vpc_id]}])['SecurityGroups']
+    if not matching_groups:
+        return None
+    return matching_groups[0]['GroupId']
+
+
+def create_security_group(prepared, context, external_ip):
+    spec = prepared['spec']
+    ec2_client = context['ec2_client']
+    run = context['run']
+
+    if spec['use_existing_security_group']:
+        sg_existing_list = [i['GroupName'] for i in context['security_groups']]
+        if spec['existing_security_group_name'] in sg_existing_list:
+            sg_selection = sg_existing_list.index(spec['existing_security_group_name'])
+            return context['security_groups'][sg_selection]['GroupId'], None
+        """The cached list may predate the group, check AWS before giving up"""
+        live_groups = ec2_client.describe_security_groups(
+            Filters=[{'Name': 'group-name', 'Values': [spec['existing_security_group_name']]}])['SecurityGroups']
+        if not live_groups:
+            raise ValueError("Invalid Existing Security Group")
+        return live_groups[0]['GroupId'], None
+
+    """Create Rules"""
+    requested_rules = build_security_group_rules(spec, prepared['confirmed_software'], external_ip)
+    security_group_rules = compact_rules(requested_rules)
+    rule_counts = {
+        'permissions': {'before': len(requested_rules), 'after': len(security_group_rules)},
+        'rules': {'before': count_rules(requested_rules), 'after': count_rules(security_group_rules)},
+    }
+    fingerprint = rules_fingerprint(security_group_rules)
+
+    """Groups with the same rules are reused, the lock stops two groups in this run from both creating one"""
+    with run['lock']:
+        group_lock = run['security_group_locks'].setdefault((context['region'], fingerprint), threading.Lock())
+    with group_lock:
+        security_group_id = find_security_group(ec2_client, context['vpc_id'], fingerprint)
+        if security_group_id is None:
+            security_group_id = create_tagged_security_group(security_group_rules, fingerprint, context)
+    return security_group_id, rule_counts
+
+
+def create_tagged_security_group(security_group_rules, fingerprint, context):
+    ec2_client = context['ec2_client']
+    run = context['run']
+    dry_run = run['settings']['dry_run']
+
+    """Name Security Group"""
+    security_group_name = f'mml-sg-0{secrets.token_hex(4)}'
+    description = f'{security_group_name} created by the MML Auto-EC2x on {datetime.now()}'
+    security_group_id = None
+    try:
+        # Create Security Group
+        response = ec2_client.create_security_group(GroupName=security_group_name,
+                                                    Description=description,
+                                                    VpcId=context['vpc_id'],
+                                                    DryRun=dry_run)
+        security_group_id = response['GroupId']
+
+        # Add self to security group rules
+        add_self = {
+            'IpProtocol': '-1',
+            'FromPort': -1,
+            'ToPort': -1,
+            'UserIdGroupPairs': [{
+                'GroupId': security_group_id
+            }]
+        }
+        security_group_rules.append(add_self)
+
+        # Set Ingress Rules
+        ec2_client.authorize_security_group_ingress(
+            GroupId=security_group_id,
+            IpPermissions=security_group_rules,
+            DryRun=dry_run
+        )
+        """Only a group that has all of its rules gets the fingerprint, so later runs never reuse a partial one"""
+        ec2_client.create_tags(Resources=[security_group_id], Tags=[{'Key': fingerprint_tag, 'Value': fingerprint}],
+                               DryRun=dry_run)
+        if run['cache'].enabled:
+            run['cache'].invalidate(get_account(run), context['region'], 'describe_security_groups')
+    except Exception:
+        print(traceback.format_exc())
+        if security_group_id is not None:
+            try:
+                ec2_client.delete_security_group(GroupId=security_group_id, DryRun=dry_run)
+            except bc.ClientError:
+                print(traceback.format_exc())
+        raise RuntimeError("Error creating Security Group, check configs")
+    return security_group_id
+
+
+def create_keypair(spec, context):
+    """Create Key Pair"""
+    if not spec['create_keypair']:
+        key_name = spec['existing_key_name']
+        return key_name, key_name+'.pem'
+
+    key_name = f'keypair_{secrets.token_hex(2)}'
+    key = context['ec2_client'].create_key_pair(KeyName=key_name, KeyType='rsa')
+    with open(f'{key_name}.pem', 'w') as file:
+        file.write(key['KeyMaterial'])
+    key_pair_location = os.path.join(os.path.dirname(os.path.realpath(__file__)), f'{key_name}.pem')
+    """Check if path has spaces, if there are spaces - add quotes, if not - keep unquoted"""
+    if " " in key_pair_location:
+        key_pair_location = key_pair_location.replace("'", "")
+        key_pair_location = f'"{key_pair_location}"'
+    return key_name, key_pair_location
+
+
+def launch_instances(prepared, context, security_group_id, key_name, hibernate=False):
+    """Create EC2 Instances, all instances in the group are launched by one call"""
+    ec2_client = context['ec2_client']
+    dry_run = context['run']['settings']['dry_run']
+    try:
+        with phase(context, 'launch', prepared):
+            create_ec2_response = ec2_client.run_instances(
+                BlockDeviceMappings=prepared['block_device_mappings'],
+                ImageId=prepared['image_id'],
+                InstanceType=prepared['selected_type'],
+                KeyName=key_name,
+                SubnetId=prepared['selected_subnetid'],
+                UserData=prepared['user_data'],
+                MaxCount=prepared['spec']['instance_count'],
+                MinCount=prepared['spec']['instance_count'],
+                Monitoring={
+                    'Enabled': False
+                },
+                Placement={
+                    'AvailabilityZone': prepared['selected_subnet']
+                },
+                SecurityGroupIds=[
+                    f'{security_group_id}',
+                ],
+                HibernationOptions={
+                    'Configured': hibernate
+                },
+                DryRun=dry_run
+                )
+
+        # Get Instance IDs
+        instance_ids = [instance['InstanceId'] for instance in create_ec2_response["Instances"]]
+
+        # Wait for Instances to Start, the region's poller checks every group launched there in one call
+        with phase(context, 'wait', prepared):
+            instances = context['poller'].wait_for_state(instance_ids, 'running',
+                                                         timeout=context['run']['settings']['state_timeout'])
+    except Exception:
+        print(traceback.format_exc())
+        raise RuntimeError("Error creating Instance, check configs")
+    return [instances[instance_id] for instance_id in instance_ids]
+
+
+def launch_fleet(prepared, context, security_group_id, key_name):
+    """Create EC2 Instances with an instant EC2 Fleet, as spot instances across the group's planned instance types
+
+    Capacity the spot request can't fill is launched on-demand with the same types (spot_on_demand_fallback). Like
+    run_instances with MinCount, the group fails as a whole if it still falls short.
+    """
+    ec2_client = context['ec2_client']
+    settings = context['run']['settings']
+    count = prepared['spec']['instance_count']
+    instance_ids = []
+    errors = []
+    template = None
+    try:
+        with phase(context, 'launch', prepared):
+            """An instant fleet only reads the launch template while launching, so it is deleted afterwards"""
+            template = ec2_client.create_launch_template(
+                LaunchTemplateName=f"mml-autoec2x-{secrets.token_hex(6)}",
+                LaunchTemplateData={
+                    'BlockDeviceMappings': prepared['block_device_mappings'],
+                    'ImageId': prepared['image_id'],
+                    'KeyName': key_name,
+                    'UserData': base64.b64encode(prepared['user_data']).decode('ascii'),
+                    'Monitoring': {'Enabled': False},
+                    'SecurityGroupIds': [security_group_id],
+                },
+                DryRun=settings['dry_run']
+            )['LaunchTemplate']
+            overrides = [{'InstanceType': offer['InstanceType'], 'SubnetId': prepared['selected_subnetid'],
+                          'Priority': float(priority)} for priority, offer in enumerate(prepared['spot_offers'])]
+            capacity_types = ['spot', 'on-demand'] if settings['spot_on_demand_fallback'] else ['spot']
+            for capacity_type in capacity_types:
+                missing = count - len(instance_ids)
+                if not missing:
+                    break
+                fleet = ec2_client.create_fleet(
+                    Type='instant',
+                    LaunchTemplateConfigs=[{
+                        'LaunchTemplateSpecification': {'LaunchTemplateId': template['LaunchTemplateId'],
+                                                        'Version': '$Latest'},
+                        'Overrides': overrides,
+                    }],
+                    TargetCapacitySpecification={
+                        'TotalTargetCapacity': missing,
+                        'DefaultTargetCapacityType': capacity_type
+                    },
+                    SpotOptions={'AllocationStrategy': 'capacity-optimized-prioritized'},
+                    OnDemandOptions={'AllocationStrategy': 'prioritized'},
+                    DryRun=settings['dry_run']
+                )
+                instance_ids += [instance_id for launched in fleet.get('Instances', [])
+                                 for instance_id in launched['InstanceIds']]
+                errors += [error.get('ErrorMessage', error.get('ErrorCode')) for error in fleet.get('Errors', [])]
+            if len(instance_ids) < count:
+                if instance_ids:
+                    ec2_client.terminate_instances(InstanceIds=instance_ids)
+                raise RuntimeError(f"EC2 Fleet launched {len(instance_ids)} of {count} instances: {errors}")
+
+        with phase(context, 'wait', prepared):
+            instances = context['poller'].wait_for_state(instance_ids, 'running', timeout=settings['state_timeout'])
+    except Exception:
+        print(traceback.format_exc())
+        raise RuntimeError("Error creating Instance, check configs")
+    finally:
+        if template is not None:
+            ec2_client.delete_launch_template(LaunchTemplateId=template['LaunchTemplateId'])
+    return [instances[instance_id] for instance_id in instance_ids]
+
+
+def attach_elastic_ip(context, instance_id):
+    """Associate an Elastic IP from the region's pool, once the run has filled it (successfully or not), so an
+    address isn't allocated twice"""
+    fill = context['run']['address_fills'].get(context['region'])
+    if fill is not None:
+        wait([fill])
+    try:
+        address = get_address_pool(context['run'], context['region']).associate(instance_id)
+    except Exception:
+        print(traceback.format_exc())
+        raise RuntimeError("Error associating Elastic IP, check configs")
+    return address['PublicIp']
+
+
+def write_readme(prepared, context, instance_id, key_pair_location, public_ip, run_time):
+    selected_region = context['region']
+    save_date = datetime.now().strftime("%m%d%y_%I%M")
+    """Fleet and multi-region launches share a timestamp, so suffix the summary with the instance ID"""
+    file_suffix = f'_{instance_id}' if context['run']['multiple_instances'] else ''
+    file_name = f'Auto-EC2x_Summary_{save_date}{file_suffix}.txt'
+    with open(f"{file_name}", "w") as readme_file:
+        readme_file.write(f"Your MML Auto-EC2 Generator Summary \n"
+        f"------------------------------------ \n"
+        f"Instance URL: https://us-east-2.console.aws.amazon.com/ec2/v2/home?region={selected_region}#InstanceDetails:instanceId={instance_id} \n"
+        f"Connect to your instance with the following command: ssh -i '{key_pair_location}' ubuntu@{public_ip} \n"
+        f"Start time: {context['run']['started']}, total run time: {run_time} minutes \n"
+        f"Image ID: {prepared['image_id']} \n"
+        f"Region: {selected_region} \n"
+        f"Instance type: {prepared['selected_type']} \n"
+        f"Subnet: {prepared['selected_subnet']} \n"
+        f"Root volume details: {prepared['block_device_mappings']} \n"
+        f"IPv4 address: {public_ip} \n"
+        f"------------------------------------ \n"
+        f"Thank you for using the MML Auto-EC2 Generator! We hope you liked this MML open source offering, if you "
+        f"have any questions or just want to chat - join us on discord: https://discord.gg/jjDcZcqXWy! \n"
+        f"To support our development, please consider subscribing at https://marketmakerlite.com/subscribe \n"
+        )
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), file_name)
+
+
+def console_output(ec2_client, instance_id, latest=True):
+    """Return the instance's console output and whether it was the latest output"""
+    try:
+        return ec2_client.get_console_output(InstanceId=instance_id, Latest=latest).get('Output', ''), latest
+    except bc.ClientError as e:
+        """Latest output is only available on Nitro instances, fall back to the buffered output"""
+        if not latest or e.response['Error']['Code'] != 'UnsupportedOperation':
+            raise
+    return ec2_client.get_console_output(InstanceId=instance_id).get('Output', ''), False
+
+
+def install_finished(instance_id, output):
+    """True once the userdata wrote the ready marker to <output>, raise if it reported failed install steps"""
+    failed = re.search(f'{failed_marker} ([^\r\n]*)', output)
+    if failed:
+        raise RuntimeError(f"Installing software failed on instance {instance_id}, failed steps: "
+                           f"{failed.group(1).strip()} (logs in {STEPS_DIRECTORY})")
+    return ready_marker in output
+
+
+def wait_for_ready(ec2_client, instance_ids, settings):
+    """Poll the console output for the marker written by the userdata once it has finished and rebooted, raise if
+    an install step failed"""
+    deadline = time.time() + settings['ready_timeout']
+    interval = settings['ready_poll_interval']
+    pending = {instance_id: True for instance_id in instance_ids}
+    while pending:
+        for instance_id, latest in list(pending.items()):
+            output, pending[instance_id] = console_output(ec2_client, instance_id, latest)
+            if install_finished(instance_id, output):
+                del pending[instance_id]
+        if not pending:
+            break
+        if time.time() + interval > deadline:
+            raise RuntimeError(f"Timed out waiting for instances {list(pending)} to finish installing software")
+        time.sleep(interval)
+        interval = min(interval * 1.5, settings['ready_poll_max_interval'])
+    return None
+
+
+def bake_image(prepared, context, instance_ids):
+    """Create an image from a finished instance, record it for later launches, then terminate the instances"""
+    ec2_client = context['ec2_client']
+    run = context['run']
+    software = ', '.join(prepared['confirmed_software']) or 'no toppings'
+    """The image is reused for every launch with the same install hash, so check again that every step succeeded"""
+    output = console_output(ec2_client, instance_ids[0])[0]
+    if not install_finished(instance_ids[0], output):
+        raise RuntimeError(f"Instance {instance_ids[0]} hasn't reported a successful install, not baking an image")
+    try:
+        image = ec2_client.create_image(
+            InstanceId=instance_ids[0],
+            Name=f"mml-autoec2x-{prepared['install_hash']}-{datetime.now().strftime('%Y%m%d%H%M%S')}",
+            Description=f"Created by the MML Auto-EC2x from {prepared['base_image_id']} with {software}",
+            DryRun=run['settings']['dry_run']
+        )
+        ec2_client.get_waiter('image_available').wait(ImageIds=[image['ImageId']],
+                                                      WaiterConfig={'Delay': 15, 'MaxAttempts': 240})
+    except Exception:
+        print(traceback.format_exc())
+        raise RuntimeError("Error creating Image, check configs")
+    run['images'].set(context['region'], prepared['base_image_id'], prepared['install_hash'], image['ImageId'])
+    ec2_client.terminate_instances(InstanceIds=instance_ids)
+    return image['ImageId']
+
+
+def warm_pool_key(spec, settings):
+    """Pooled instances are matched on every launch setting except the count and <warm_pool_match_ignore>"""
+    ignored = {'instance_count', 'use_elastic_ip', 'create_readme'} | set(settings['warm_pool_match_ignore'])
+    launch_settings = {key: value for key, value in spec.items() if key not in ignored}
+    return hashlib.sha256(json.dumps(launch_settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def find_warm_instances(context, key, states=('stopped',)):
+    paginator = context['ec2_client'].get_paginator('describe_instances')
+    filters = [{'Name': f'tag:{warm_pool_tag}', 'Values': [key]}, {'Name': 'instance-state-name', 'Values': list(states)}]
+    return [instance for page in paginator.paginate(Filters=filters) for reservation in page['Reservations']
+            for instance in reservation['Instances']]
+
+
+def take_warm_instances(prepared, context, security_group_id):
+    """Claim up to instance_count pooled instances and start them, return their IDs without waiting"""
+    ec2_client = context['ec2_client']
+    run = context['run']
+    key = warm_pool_key(prepared['spec'], run['settings'])
+    """Groups in this run that match the same pool take turns, so no instance is claimed twice"""
+    with run['lock']:
+        pool_lock = run['warm_pool_locks'].setdefault((context['region'], key), threading.Lock())
+    with pool_lock:
+        instances = find_warm_instances(context, key)[:prepared['spec']['instance_count']]
+        instance_ids = [instance['InstanceId'] for instance in instances]
+        if instance_ids:
+            ec2_client.delete_tags(Resources=instance_ids, Tags=[{'Key': warm_pool_tag}])
+    if not instance_ids:
+        return []
+    """The pooled instance may predate this run's rules (e.g. a new external IP), give it this run's group"""
+    started = []
+    for instance in instances:
+        try:
+            if [group['GroupId'] for group in instance.get('SecurityGroups', [])] != [security_group_id]:
+                ec2_client.modify_instance_attribute(InstanceId=instance['InstanceId'], Groups=[security_group_id])
+            started.append(instance['InstanceId'])
+        except bc.ClientError:
+            print(traceback.format_exc())
+    try:
+        if started:
+            ec2_client.start_instances(InstanceIds=started, DryRun=run['settings']['dry_run'])
+    except bc.ClientError:
+        """e.g. InsufficientInstanceCapacity, none of them were started"""
+        print(traceback.format_exc())
+        started = []
+    """Instances that couldn't be started go back to the pool, and the group launches their share instead"""
+    returned = [instance_id for instance_id in instance_ids if instance_id not in started]
+    if returned:
+        ec2_client.create_tags(Resources=returned, Tags=[{'Key': warm_pool_tag, 'Value': key}])
+    return started
+
+
+def fill_warm_pool(prepared, context, external_ip):
+    """Top the spec's warm pool up to warm_pool_size: launch, wait for the software, stop (or hibernate) and tag
+
+    Pooled instances idle for longer than warm_pool_max_age are terminated and replaced.
+    """
+    ec2_client = context['ec2_client']
+    settings = context['run']['settings']
+    spec = prepared['spec']
+    key = warm_pool_key(spec, settings)
+    pooled = find_warm_instances(context, key, states=('pending', 'running', 'stopping', 'stopped'))
+    expired = [instance['InstanceId'] for instance in pooled if settings['warm_pool_max_age'] is not None and
+               time.time() - instance['LaunchTime'].timestamp() > settings['warm_pool_max_age']]
+    if expired:
+        ec2_client.terminate_instances(InstanceIds=expired)
+    missing = settings['warm_pool_size'] - (len(pooled) - len(expired))
+
+    launched = []
+    if missing > 0:
+        with phase(context, 'security group', prepared):
+            security_group_id, rule_counts = create_security_group(prepared, context, external_ip)
+        with phase(context, 'key pair', prepared):
+            key_name, key_pair_location = create_keypair(spec, context)
+        instances = launch_instances(dict(prepared, spec=dict(spec, instance_count=missing)), context,
+                                     security_group_id, key_name, hibernate=settings['warm_pool_idle'] == 'hibernate')
+        launched = [instance['InstanceId'] for instance in instances]
+        with phase(context, 'readiness', prepared):
+            wait_for_ready(ec2_client, launched, settings)
+        with phase(context, 'stop', prepared):
+            ec2_client.stop_instances(InstanceIds=launched, Hibernate=settings['warm_pool_idle'] == 'hibernate')
+            context['poller'].wait_for_state(launched, 'stopped', timeout=settings['state_timeout'])
+        """Only tagged once stopped, so a run never claims an instance that is still being set up"""
+        ec2_client.create_tags(Resources=launched, Tags=[{'Key': warm_pool_tag, 'Value': key}])
+    return [{
+        "Warm pool": key,
+        "Region": context['region'],
+        "Instance type": prepared['selected_type'],
+        "pooled": len(pooled) - len(expired) + len(launched),
+        "launched": launched,
+        "terminated": expired,
+        "time completed": datetime.now().strftime("%m%d%y_%I%M")
+    }]
+
+
+def provision_group(prepared, context, external_ip):
+    """Run the steps for a group of identical instances: security group, key pair, launch, Elastic IP, summary
+
+    With a warm pool, pooled instances are started first and only the rest are launched (and installed) from scratch.
+    """
+    spec = prepared['spec']
+    selected_region = context['region']
+    settings = context['run']['settings']
+    if settings['fill_warm_pool']:
+        return fill_warm_pool(prepared, context, external_ip)
+
+    with phase(context, 'security group', prepared):
+        security_group_id, rule_counts = create_security_group(prepared, context, external_ip)
+    warm_ids = []
+    if settings['warm_pool_size'] and not settings['bake_image']:
+        with phase(context, 'warm start', prepared):
+            warm_ids = take_warm_instances(prepared, context, security_group_id)
+    cold_count = spec['instance_count'] - len(warm_ids)
+
+    instances = []
+    key_pair_location = None
+    if cold_count:
+        with phase(context, 'key pair', prepared):
+            key_name, key_pair_location = create_keypair(spec, context)
+        launch = launch_fleet if spec['spot'] else launch_instances
+        instances = launch(dict(prepared, spec=dict(spec, instance_count=cold_count)), context, security_group_id,
+                           key_name)
+    if warm_ids:
+        with phase(context, 'wait', prepared):
+            instances += context['poller'].wait_for_state(warm_ids, 'running',
+                                                          timeout=settings['state_timeout']).values()
+    instance_ids = [instance['InstanceId'] for instance in instances]
+
+    public_ips = {instance['InstanceId']: instance.get('PublicDnsName') for instance in instances}
+    if spec['use_elastic_ip'] and not settings['bake_image']:
+        with phase(context, 'elastic ip', prepared):
+            for instance_id in instance_ids:
+                public_ips[instance_id] = attach_elastic_ip(context, instance_id)
+            """Return once the instances are reachable on their Elastic IPs"""
+            context['poller'].wait(instance_ids, has_public_ips(public_ips), timeout=settings['state_timeout'])
+
+    """A baked image must have the software installed, so baking always waits"""
+    """Warm instances were ready before they were stopped"""
+    if settings['wait_until_ready'] or settings['bake_image']:
+        with phase(context, 'readiness', prepared):
+            wait_for_ready(context['ec2_client'], [instance_id for instance_id in instance_ids
+                                                   if instance_id not in warm_ids], settings)
+    if settings['bake_image']:
+        with phase(context, 'bake', prepared):
+            baked_image_id = bake_image(prepared, context, instance_ids)
+        return [{
+            "Image": baked_image_id,
+            "Base image": prepared['base_image_id'],
+            "Region": selected_region,
+            "Software": prepared['confirmed_software'],
+            "Install hash": prepared['install_hash'],
+            "Bake instance": instance_ids[0],
+            "runtime": "{:.2f}".format((time.time() - context['run']['start_time'])/60),
+            "time completed": datetime.now().strftime("%m%d%y_%I%M")
+        }]
+
+    run_time = "{:.2f}".format((time.time() - context['run']['start_time'])/60)
+    responses = []
+    for instance in instances:
+        instance_id = instance['InstanceId']
+        public_ip = public_ips[instance_id]
+        location = key_pair_location
+        if instance_id in warm_ids:
+            """The key pair is the one the pooled instance was launched with"""
+            location = os.path.join(os.path.dirname(os.path.realpath(__file__)), f"{instance['KeyName']}.pem")
+        if spec['create_readme']:
+            write_readme(prepared, context, instance_id, location, public_ip, run_time)
+
+        responses.append({
+            "instance_id": instance_id,
+            "instance_url": f'https://{selected_region}.console.aws.amazon.com/ec2/v2/home?region={selected_region}#InstanceDetails:instanceId={instance_id}',
+            "ssh": f'ssh -i {location} ubuntu@{public_ip}',
+            "Region": selected_region,
+            "Instance type": instance['InstanceType'],
+            "Lifecycle": instance.get('InstanceLifecycle', 'on-demand'),
+            "Spot offers": prepared['spot_offers'],
+            "Image": instance['ImageId'],
+            "Baked image": prepared['baked'],
+            "Subnet": prepared['selected_subnet'],
+            "Security group": security_group_id,
+            "Security group rules": rule_counts,
+            "Root volume details": prepared['block_device_mappings'],
+            "User data": prepared['user_data_size'],
+            "ip_address": public_ip,
+            "runtime": run_time,
+            "ready": settings['wait_until_ready'] or instance_id in warm_ids,
+            "Warm start": instance_id in warm_ids,
+            "State changes": [{"state": state, "seconds": round(changed - context['run']['start_time'], 1)}
+                              for state, changed in context['poller'].history.get(instance_id, [])],
+            "time completed": datetime.now().strftime("%m%d%y_%I%M")
+        })
+    return responses
+
+
+def provision(spec, session=None, cache=None, refresh=False):
+    """Provision the instance(s) described by <spec> and return the structured result
+
+    <spec> uses the same names as config.py, anything left out takes its default. Pass the same boto3 <session>
+    to every call to reuse its clients and connection pool; without one a shared default session is used.
+    Instances that fail are reported under "errors" instead of raising, invalid settings raise ValueError.
+    """
+    unknown = [key for key in spec if key not in INSTANCE_DEFAULTS and key not in RUN_DEFAULTS]
+    if unknown:
+        raise ValueError(f"Invalid settings: {unknown}")
+    settings = dict(INSTANCE_DEFAULTS, **RUN_DEFAULTS)
+    settings.update(spec)
+    session = session or default_session()
+    timeline = Timeline()
+    with timeline.span('credentials'):
+        if session.get_credentials() is None:
+            raise bc.NoCredentialsError()
+
+    run = {
+        'settings': settings,
+        'session': session,
+        'clients': get_client_factory(session, settings),
+        'cache': cache or get_cache(settings, refresh),
+        'start_time': time.time(),
+        'started': datetime.now().strftime("%Y-%m-%d %I:%M:%S"),
+        'lock': threading.Lock(),
+        'security_group_locks': {},
+        'address_pools': {},
+        'address_fills': {},
+        'warm_pool_locks': {},
+        'timeline': timeline,
+    }
+    if settings['bake_image'] or settings['use_baked_images']:
+        run['images'] = ImageRegistry(os.path.join(os.path.dirname(run['cache'].path), 'images.sqlite3'))
+
+    """Every API call made while the run is going is counted in its timeline"""
+    with session_state(session)['api_recorder'].recording(timeline):
+        result = provision_run(spec, run)
+    result['timeline'] = timeline.to_dict()
+    if settings['timeline_path'] is not None:
+        timeline.save(settings['timeline_path'])
+    return json.loads(json.dumps(result))
+
+
+def provision_run(spec, run):
+    """Look up, prepare and launch everything for one provision() call"""
+    settings = run['settings']
+    session = run['session']
+    default_region = session.region_name or settings['selected_region']
+
+    """Regions"""
+    if settings['regions']:
+        """Multi-region mode deploys the same instance(s) to every listed region"""
+        selected_regions = list(dict.fromkeys(settings['regions']))
+    elif settings['use_default_region']:
+        selected_regions = [default_region]
+    else:
+        selected_regions = [settings['selected_region']]
+
+    if settings['fleet']:
+        specs = [build_spec(settings, overrides) for overrides in settings['fleet']]
+    else:
+        specs = [build_spec(settings)]
+    """Spot groups choose between similar instance types, so they need the catalog too"""
+    need_catalog = any(instance_spec['instance_requirements'] or instance_spec['spot'] for instance_spec in specs)
+
+    """Every lookup needed before launching is independent, so they all run at once"""
+    """The external IP is only needed for new strict Security Groups, look it up once for the whole run"""
+    need_external_ip = any(not instance_spec['use_existing_security_group'] and
+                           str(instance_spec['strict_or_relaxed']).lower() == 'strict' for instance_spec in specs)
+    need_addresses = 0 if settings['bake_image'] or settings['fill_warm_pool'] else sum(
+        instance_spec['instance_count'] for instance_spec in specs if instance_spec['use_elastic_ip'])
+    """The default region needs no validation, so describe_regions is only called for explicitly chosen regions"""
+    validate_regions = selected_regions != [default_region]
+    with ThreadPoolExecutor(max_workers=2 + 5 * len(selected_regions)) as executor:
+        prefetch = Prefetch(executor, run['timeline'])
+        if need_external_ip:
+            prefetch.submit('external_ip', get_external_ip)
+        if validate_regions:
+            prefetch.submit('describe_regions', cached_call, run, '', 'describe_regions', lambda: [
+                region['RegionName'] for region in get_ec2_client(run, default_region).describe_regions()['Regions']])
+        for region in selected_regions:
+            prefetch_region(prefetch, run, region, need_catalog)
+
+        if validate_regions:
+            regions = prefetch.result('describe_regions')
+            invalid_regions = [region for region in selected_regions if region not in regions]
+            if invalid_regions:
+                raise ValueError(f"Invalid Region: {invalid_regions}")
+
+        """Instance Types / Subnets / Security Groups"""
+        contexts = [discover_region(prefetch, run, region, need_catalog) for region in selected_regions]
+        external_ip = prefetch.result('external_ip') if need_external_ip else None
+
+        """Validate every instance (storage, software, subnet, type, image) in every region before creating anything"""
+        """Identical specs are launched together, so a homogeneous tier costs one run_instances call per region"""
+        groups = group_specs(specs)
+        tasks = []
+        for context in contexts:
+            for group in groups:
+                with run['timeline'].span('prepare', region=context['region'], group=len(tasks)):
+                    prepared = dict(prepare_instance(group['spec'], context), group=len(tasks))
+                tasks.append((group['fleet_indexes'], prepared, context))
+    requested = sum(prepared['spec']['instance_count'] for fleet_indexes, prepared, context in tasks)
+    run['multiple_instances'] = bool(settings['fleet']) or requested > 1
+
+    """Each group runs on its own worker, so the run takes as long as its slowest group"""
+    max_workers = max(1, min(settings['fleet_max_workers'] * len(contexts), len(tasks)))
+    with ThreadPoolExecutor(max_workers=max_workers + (len(contexts) if need_addresses else 0)) as executor:
+        """The Elastic IPs are allocated alongside the launches, which only need them once their instances are
+        running. Nothing is allocated for a run that failed validation, and a failure here is left to the launches
+        that need an address"""
+        if need_addresses:
+            prefetch = Prefetch(executor, run['timeline'])
+            for context in contexts:
+                run['address_fills'][context['region']] = prefetch.submit(
+                    (context['region'], 'address_pool'), get_address_pool(run, context['region']).fill,
+                    need_addresses + settings['elastic_ip_pool_size'])
+        futures = [executor.submit(provision_group, prepared, context, external_ip)
+                   for fleet_indexes, prepared, context in tasks]
+
+    instances = []
+    errors = []
+    for (fleet_indexes, prepared, context), future in zip(tasks, futures):
+        try:
+            instances.extend(future.result())
+        except Exception as e:
+            errors.append({"fleet_indexes": fleet_indexes, "Region": context['region'], "error": str(e)})
+
+    """Replace the pooled instances this run started, the next run can start them while this one returns"""
+    refilling = bool(settings['warm_pool_size']) and not settings['fill_warm_pool'] and not settings['bake_image']
+    if refilling:
+        refill_warm_pool(spec, session, run['cache'])
+
+    result = {
+        "instances": instances,
+        "errors": errors,
+        "Regions": selected_regions,
+        "requested": requested,
+        "created": len(instances),
+        "runtime": "{:.2f}".format((time.time() - run['start_time'])/60),
+        "startup": dict(startup),
+        "warm pool refilling": refilling,
+        "time completed": datetime.now().strftime("%m%d%y_%I%M")
+    }
+    return result
+
+
+def refill_warm_pool(spec, session=None, cache=None):
+    """Fill the warm pool for <spec> on a background thread, see wait_for_refills()"""
+    executor = ThreadPoolExecutor(max_workers=1)
+    with _state_lock:
+        _warm_pool_refills.append(executor.submit(provision, dict(spec, fill_warm_pool=True), session, cache))
+    executor.shutdown(wait=False)
+    return None
+
+
+def wait_for_refills():
+    """Wait for the warm pool refills started so far, return their results and the errors of those that failed"""
+    with _state_lock:
+        refills = list(_warm_pool_refills)
+        del _warm_pool_refills[:]
+    results = []
+    errors = []
+    for refill in refills:
+        try:
+            result = refill.result()
+        except Exception as e:
+            errors.append({"error": str(e)})
+            continue
+        results.append(result)
+        errors.extend(result['errors'])
+    return results, errors
+
+
+def terminate(instance_ids, region=None, session=None, spec=None):
+    """Terminate instances launched by provision(), returning their Elastic IPs to the pool first
+
+    <spec> takes the same run settings as provision(). The pool keeps up to <elastic_ip_pool_size> free addresses for later launches and releases the rest.
+    """
+    settings = dict(RUN_DEFAULTS)
+    settings.update({key: value for key, value in (spec or {}).items() if key in RUN_DEFAULTS})
+    session = session or default_session()
+    ec2_client = get_client_factory(session, settings).client('ec2', region or session.region_name or
+                                                              settings['selected_region'])
+    address_pool = AddressPool(ec2_client, settings['elastic_ip_pool'], settings['dry_run'])
+    released = address_pool.release(instance_ids)
+    ec2_client.terminate_instances(InstanceIds=instance_ids, DryRun=settings['dry_run'])
+    address_pool.drain(keep=settings['elastic_ip_pool_size'])
+    InstancePoller(ec2_client, interval=settings['state_poll_interval'],
+                   max_interval=settings['state_poll_max_interval']).wait_for_state(
+        instance_ids, 'terminated', timeout=settings['state_timeout'])
+    return {"terminated": list(instance_ids), "Elastic IPs returned": released}
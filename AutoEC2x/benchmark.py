@@ -0,0 +1,230 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+from autoec2x import INSTANCE_DEFAULTS, provision
+from autoec2_common.base_images import UBUNTU_ARCHITECTURES, UBUNTU_PARAMETER
+from botocore.awsrequest import AWSResponse
+from timeline import critical_path, operation_name
+from urllib.parse import parse_qs
+import argparse
+import boto3
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    from moto import mock_aws
+    from moto.core.botocore_stubber import MockRawResponse
+    from moto.core.models import botocore_stubber
+except ImportError:
+    mock_aws = None
+
+"""Every scenario launches without contacting anything but the stand-in: no external IP lookup, no readiness checks"""
+BASE_SPEC = {'strict_or_relaxed': 'relaxed', 'wait_until_ready': False}
+SCENARIOS = {
+    '1 instance': {},
+    '50-instance fleet': {'fleet': [{'instance_type': 't3.micro', 'instance_count': 20},
+                                    {'instance_type': 't3.small', 'instance_count': 20},
+                                    {'instance_type': 't3.medium', 'instance_count': 8, 'use_elastic_ip': True},
+                                    {'instance_type': 't3.large', 'instance_count': 2, 'volume_size': '20 GB'}]},
+    'multi-region': {'regions': ['us-east-1', 'us-east-2', 'us-west-2'],
+                     'fleet': [{'instance_type': 't3.small', 'instance_count': 2},
+                               {'instance_type': 't3.medium', 'use_elastic_ip': True}]},
+}
+DEFAULT_REGION = 'us-east-1'
+ERROR_STATUS = {'RequestLimitExceeded': 503, 'InsufficientInstanceCapacity': 500}
+
+
+class StandIn:
+    """Answers the run's AWS calls from moto, slowed down and made to fail the way AWS does
+
+    <latency> is the seconds each call takes, by operation ('ec2.RunInstances') or for every other call under
+    '*'. <page_size> sets MaxResults on paginated EC2 calls that don't set it, so their paginators make several
+    calls. Every <throttle_every>th attempt at an EC2 operation is throttled, and <capacity> is how many instances
+    of each instance type run_instances can launch before it fails with InsufficientInstanceCapacity.
+    """
+
+    def __init__(self, latency=None, page_size=None, throttle_every=None, capacity=None):
+        if mock_aws is None:
+            raise RuntimeError("The benchmark needs moto: pip install 'moto[ec2,ssm,sts]'")
+        self.latency = latency or {}
+        self.page_size = page_size or {}
+        self.throttle_every = throttle_every or {}
+        for name in list(self.page_size) + list(self.throttle_every):
+            if not name.startswith('ec2.'):
+                raise ValueError(f"Only EC2 operations can be paged or throttled: {name}")
+        self.capacity = dict(capacity or {})
+        self.attempts = {}
+        self.images = {}
+        self._lock = threading.Lock()
+
+    def attach(self, session):
+        """Route <session>'s calls through the stand-in, before any of its clients are created"""
+        session.events.unregister('before-send', botocore_stubber)
+        session.events.register('before-send', self.before_send)
+        return None
+
+    def seed(self, session, regions):
+        """Create what a real account already has: the key pair and an Ubuntu image in every region"""
+        for region in regions:
+            ec2_client = session.client('ec2', region_name=region)
+            ec2_client.create_key_pair(KeyName=INSTANCE_DEFAULTS['existing_key_name'])
+            for architecture, ubuntu_architecture in UBUNTU_ARCHITECTURES.items():
+                images = ec2_client.describe_images(
+                    Owners=['amazon'], Filters=[{'Name': 'architecture', 'Values': [architecture]}])['Images']
+                self.images[(region, UBUNTU_PARAMETER.format(architecture=ubuntu_architecture))] = images[0]['ImageId']
+        return None
+
+    def _count(self, name):
+        with self._lock:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            return self.attempts[name]
+
+    def _launch(self, params):
+        """Take run_instances' instances out of the remaining capacity for their type, False if there isn't enough"""
+        instance_type = params.get('InstanceType', ['m1.small'])[0]
+        count = int(params.get('MinCount', ['1'])[0])
+        with self._lock:
+            if instance_type not in self.capacity:
+                return True
+            if self.capacity[instance_type] < count:
+                return False
+            self.capacity[instance_type] -= count
+        return True
+
+    def before_send(self, event_name, request, **kwargs):
+        name = operation_name(event_name)
+        attempt = self._count(name)
+        time.sleep(self.latency.get(name, self.latency.get('*', 0)))
+
+        if name in self.throttle_every and attempt % self.throttle_every[name] == 0:
+            return error_response(request, 'RequestLimitExceeded', 'Request limit exceeded.')
+        if name == 'ssm.GetParameter':
+            """moto doesn't publish Canonical's parameters, answer with the seeded image instead"""
+            parameter = json.loads(request.body)['Name']
+            region = request.context.get('client_region')
+            if (region, parameter) in self.images:
+                return json_response(request, {'Parameter': {'Name': parameter, 'Type': 'String',
+                                                             'Value': self.images[(region, parameter)]}})
+
+        if name.startswith('ec2.'):
+            body = request.body.decode('utf8') if isinstance(request.body, bytes) else request.body
+            params = parse_qs(body)
+            if name in self.page_size and 'MaxResults' not in params:
+                request.body = f"{body}&MaxResults={self.page_size[name]}"
+                request.headers['Content-Length'] = str(len(request.body))
+            if name == 'ec2.RunInstances' and not self._launch(params):
+                return error_response(request, 'InsufficientInstanceCapacity',
+                                      'We currently do not have sufficient capacity in the Availability Zone you '
+                                      'requested.')
+        return botocore_stubber(event_name=event_name, request=request, **kwargs)
+
+
+def error_response(request, code, message):
+    """An EC2 error response, as the query protocol returns it"""
+    body = (f'<?xml version="1.0" encoding="UTF-8"?>\n<Response><Errors><Error><Code>{code}</Code>'
+            f'<Message>{message}</Message></Error></Errors><RequestID>stand-in</RequestID></Response>')
+    return AWSResponse(request.url, ERROR_STATUS.get(code, 400), {}, MockRawResponse(body))
+
+
+def json_response(request, data):
+    return AWSResponse(request.url, 200, {'Content-Type': 'application/x-amz-json-1.1'},
+                       MockRawResponse(json.dumps(data)))
+
+
+def summarize(result, wall_seconds, stand_in):
+    timeline = result['timeline']
+    path = critical_path(timeline['spans'])
+    return {
+        'wall_seconds': round(wall_seconds, 3),
+        'critical_path_seconds': round(sum(span['seconds'] for span in path), 3),
+        'critical_path': [span['phase'] for span in reversed(path)],
+        'api_calls': timeline['api_calls'],
+        'attempts': sum(stand_in.attempts.values()),
+        'retries': sum(operation['retries'] for operation in timeline['api'].values()),
+        'throttles': sum(operation['throttles'] for operation in timeline['api'].values()),
+        'errors': len(result['errors']),
+        'requested': result['requested'],
+        'created': result['created'],
+        'phase_seconds': timeline['phase_seconds'],
+        'api': {name: operation['calls'] for name, operation in timeline['api'].items()},
+    }
+
+
+def run_scenario(spec, repeat=1, **stand_in_options):
+    """Provision <spec> <repeat> times against a fresh stand-in, return a summary of each run
+
+    The runs share one moto account and metadata cache, so the first run is cold and the others show what the
+    cache saves.
+    """
+    spec = dict(BASE_SPEC, **spec)
+    regions = spec.get('regions') or [DEFAULT_REGION]
+    summaries = []
+    with mock_aws(), tempfile.TemporaryDirectory() as cache_dir:
+        spec['cache_path'] = os.path.join(cache_dir, 'metadata.sqlite3')
+        stand_in = StandIn(**stand_in_options)
+        stand_in.seed(boto3.session.Session(region_name=DEFAULT_REGION), regions)
+        session = boto3.session.Session(region_name=DEFAULT_REGION)
+        stand_in.attach(session)
+        for _ in range(repeat):
+            stand_in.attempts = {}
+            start = time.perf_counter()
+            result = provision(spec, session=session)
+            summaries.append(summarize(result, time.perf_counter() - start, stand_in))
+    return summaries
+
+
+def parse_assignments(values, convert):
+    """['ec2.RunInstances=0.2', ...] -> {'ec2.RunInstances': 0.2, ...}"""
+    assignments = {}
+    for value in values or []:
+        name, separator, setting = value.rpartition('=')
+        if not separator:
+            raise ValueError(f"Expected NAME=VALUE: {value}")
+        assignments[name] = convert(setting)
+    return assignments
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MML Auto-EC2x against a local AWS stand-in')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='Scenario to run, may be repeated (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per scenario, the first one with a cold cache')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds every API call takes')
+    parser.add_argument('--operation-latency', nargs='+', metavar='OPERATION=SECONDS',
+                        help="Latency of single operations, e.g. ec2.RunInstances=0.5")
+    parser.add_argument('--page-size', nargs='+', metavar='OPERATION=COUNT',
+                        help='MaxResults for paginated EC2 calls, e.g. ec2.DescribeInstances=5')
+    parser.add_argument('--throttle-every', nargs='+', metavar='OPERATION=N',
+                        help='Throttle every Nth attempt at an EC2 operation, e.g. ec2.DescribeInstances=3')
+    parser.add_argument('--capacity', nargs='+', metavar='INSTANCE_TYPE=COUNT',
+                        help='Instances of a type that can be launched, e.g. t3.large=1')
+    parser.add_argument('--json', action='store_true', help='Print the full summaries as JSON lines')
+    args = parser.parse_args()
+
+    stand_in_options = {
+        'latency': dict(parse_assignments(args.operation_latency, float), **{'*': args.latency}),
+        'page_size': parse_assignments(args.page_size, int),
+        'throttle_every': parse_assignments(args.throttle_every, int),
+        'capacity': parse_assignments(args.capacity, int),
+    }
+    for name in args.scenario or list(SCENARIOS):
+        for run, summary in enumerate(run_scenario(SCENARIOS[name], args.repeat, **stand_in_options), 1):
+            if args.json:
+                print(json.dumps(dict(summary, scenario=name, run=run)))
+                continue
+            print(f"{name} (run {run}): {summary['wall_seconds']}s wall, {summary['critical_path_seconds']}s "
+                  f"critical path, {summary['api_calls']} API calls ({summary['attempts']} attempts, "
+                  f"{summary['throttles']} throttled), {summary['created']}/{summary['requested']} instances, "
+                  f"{summary['errors']} errors")
+            print(f"    critical path: {' > '.join(summary['critical_path'])}")
+    return None
+
+
+if __name__ == '__main__':
+    main()
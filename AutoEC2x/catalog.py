@@ -0,0 +1,145 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import json
+import os
+import re
+import time
+import numpy as np
+
+"""Architectures are stored as a bitmask so one integer column covers instances supporting several"""
+ARCHITECTURES = {'i386': 1, 'x86_64': 2, 'arm64': 4, 'x86_64_mac': 8, 'arm64_mac': 16}
+COLUMNS = {
+    'vcpus': np.int32,
+    'memory_mib': np.int64,
+    'architecture': np.int32,
+    'network_gbps': np.float32,
+    'ebs_mbps': np.int32,
+    'storage_gb': np.int64,
+    'burstable': np.bool_,
+}
+NETWORK_LEVELS = {'very low': 0.05, 'low': 0.1, 'low to moderate': 0.3, 'moderate': 0.5, 'high': 1.0}
+
+
+def parse_network_performance(network_performance):
+    """Convert 'Up to 25 Gigabit', '100 Gigabit', 'Moderate' etc. to Gbps"""
+    text = network_performance.lower().replace('up to ', '').strip()
+    match = re.match(r'([\d.]+)\s*(gigabit|megabit)', text)
+    if match:
+        value = float(match.group(1))
+        return value if match.group(2) == 'gigabit' else value / 1000
+    return NETWORK_LEVELS.get(text, 0.0)
+
+
+def catalog_row(record):
+    architecture = 0
+    for name in record.get('ProcessorInfo', {}).get('SupportedArchitectures', []):
+        architecture |= ARCHITECTURES.get(name, 0)
+    return {
+        'vcpus': record['VCpuInfo']['DefaultVCpus'],
+        'memory_mib': record['MemoryInfo']['SizeInMiB'],
+        'architecture': architecture,
+        'network_gbps': parse_network_performance(record.get('NetworkInfo', {}).get('NetworkPerformance', '')),
+        'ebs_mbps': record.get('EbsInfo', {}).get('EbsOptimizedInfo', {}).get('MaximumBandwidthInMbps', 0),
+        'storage_gb': record.get('InstanceStorageInfo', {}).get('TotalSizeInGB', 0),
+        'burstable': record.get('BurstablePerformanceSupported', False),
+    }
+
+
+class InstanceTypeCatalog:
+    """Columnar view of describe_instance_types, one NumPy array per attribute"""
+
+    def __init__(self, names, columns):
+        self.names = names
+        self.columns = columns
+        self._index = None
+
+    @classmethod
+    def build(cls, records):
+        records = sorted(records, key=lambda record: record['InstanceType'])
+        rows = [catalog_row(record) for record in records]
+        names = np.array([record['InstanceType'] for record in records], dtype=str)
+        columns = {column: np.array([row[column] for row in rows], dtype=dtype) for column, dtype in COLUMNS.items()}
+        return cls(names, columns)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'names.npy'), self.names)
+        for column, values in self.columns.items():
+            np.save(os.path.join(directory, f'{column}.npy'), values)
+        """Written last, so a catalog interrupted mid-save is never treated as complete"""
+        with open(os.path.join(directory, 'meta.json'), 'w') as meta_file:
+            json.dump({'built': time.time(), 'count': len(self.names)}, meta_file)
+        return None
+
+    @classmethod
+    def load(cls, directory, max_age=None):
+        """Memory-map a saved catalog, or return None if it is missing or older than <max_age> seconds"""
+        try:
+            with open(os.path.join(directory, 'meta.json')) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        if max_age is not None and time.time() - meta['built'] > max_age:
+            return None
+        names = np.load(os.path.join(directory, 'names.npy'), mmap_mode='r')
+        columns = {column: np.load(os.path.join(directory, f'{column}.npy'), mmap_mode='r') for column in COLUMNS}
+        return cls(names, columns)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, instance_type):
+        if self._index is None:
+            self._index = {str(name): i for i, name in enumerate(self.names)}
+        return instance_type in self._index
+
+    def match(self, requirements):
+        """Return a boolean mask of the instance types meeting <requirements>"""
+        columns = self.columns
+        mask = np.ones(len(self.names), dtype=bool)
+        minimums = {'min_vcpus': columns['vcpus'], 'min_memory_gib': columns['memory_mib'] / 1024,
+                    'min_network_gbps': columns['network_gbps'], 'min_ebs_mbps': columns['ebs_mbps'],
+                    'min_storage_gb': columns['storage_gb']}
+        maximums = {'max_vcpus': columns['vcpus'], 'max_memory_gib': columns['memory_mib'] / 1024,
+                    'max_network_gbps': columns['network_gbps']}
+        unknown = [key for key in requirements if key not in minimums and key not in maximums
+                   and key not in ('architecture', 'burstable')]
+        if unknown:
+            raise ValueError(f"Invalid instance requirements: {unknown}")
+        for key, values in minimums.items():
+            if requirements.get(key) is not None:
+                mask &= values >= requirements[key]
+        for key, values in maximums.items():
+            if requirements.get(key) is not None:
+                mask &= values <= requirements[key]
+        if requirements.get('architecture') is not None:
+            if requirements['architecture'] not in ARCHITECTURES:
+                raise ValueError(f"Invalid architecture: {requirements['architecture']}")
+            mask &= (columns['architecture'] & ARCHITECTURES[requirements['architecture']]) != 0
+        if requirements.get('burstable') is not None:
+            mask &= columns['burstable'] == bool(requirements['burstable'])
+        return mask
+
+    def select(self, requirements, count=1):
+        """Return up to <count> matching instance types, smallest first
+
+        describe_instance_types carries no prices, so the smallest instance (fewest vCPUs, then least memory,
+        network and storage) is used as the cheapest one.
+        """
+        matches = np.flatnonzero(self.match(requirements))
+        columns = self.columns
+        order = np.lexsort((self.names[matches], columns['storage_gb'][matches], columns['network_gbps'][matches],
+                            columns['memory_mib'][matches], columns['vcpus'][matches]))
+        return [str(name) for name in self.names[matches[order[:count]]]]
+
+    def architectures(self, instance_type):
+        i = np.flatnonzero(self.names == instance_type)[0]
+        return [name for name, bit in ARCHITECTURES.items() if self.columns['architecture'][i] & bit]
+
+    def describe(self, instance_type):
+        i = np.flatnonzero(self.names == instance_type)[0]
+        return {column: values[i].item() for column, values in self.columns.items()}
@@ -13,6 +13,10 @@
 # [1: 'Postgres', 2: 'MongoDB', 3: 'MySQL', 4: 'sqlite3', 5: 'Redis', 6: 'Docker',
 # 7: 'Git', 8: 'Nginx', 9: 'Caddy', 10: 'Apache', 11: 'NodeJS', 12: 'Airflow']
 
+# Instead of a fixed instance_type, you can describe the instance you need, e.g.:
+# instance_requirements = {'min_vcpus': 8, 'min_memory_gib': 32, 'min_network_gbps': 25, 'architecture': 'x86_64'}
+# Other keys: max_vcpus, max_memory_gib, max_network_gbps, min_ebs_mbps, min_storage_gb, burstable (True/False)
+
 # You can add custom userdata in the following format:
 # custom_userdata = '''#
 # apt -y update
@@ -21,6 +25,7 @@
 # #Install pip
 # apt install python3-pip
 # '''
+# custom_userdata may also be a cloud-config document starting with '#cloud-config'.
 
 ################################################################################
 # GENERAL / CONNECTIONS
@@ -30,13 +35,53 @@ access_key_id = 'BRLO5fXXXXXRZV843HJ9'                          # Replace with y
 secret_access_key = 'K3FH68epXXXXXlLT7hYtMfr4nXFWsB5zKSipLZWy'  # Replace with your Secret Access Key
 create_readme = True
 ###############################################################################
+# CACHE SETTINGS
+###############################################################################
+use_cache = True                                                # Cache regions, instance types, subnets, VPCs and security groups between runs
+cache_path = None                                               # Defaults to ~/.cache/mml-autoec2/metadata.sqlite3, run with --refresh to bypass the cache
+cache_ttl = {}                                                  # Override the seconds each lookup is cached, e.g. {'describe_security_groups': 60}
+###############################################################################
+# CONNECTION SETTINGS
+###############################################################################
+max_pool_connections = None                                     # Connections kept open per region, defaults to fleet_max_workers (at least 10)
+tcp_keepalive = True
+retry_mode = 'standard'                                         # Options: 'legacy', 'standard', 'adaptive'
+max_attempts = 5                                                # Attempts per API call, including the first one
+timeline_path = None                                            # e.g. 'timelines.jsonl' to append each run's phase timings and API call counts as a JSON line
+###############################################################################
 # INSTANCE SETTINGS
 ###############################################################################
 use_default_region = True
 selected_region = 'us-east-2'
 instance_type = 't2.micro'
+instance_requirements = None                                    # Use the smallest instance type meeting these instead of instance_type, see below
+instance_count = 1                                              # Number of identical instances, launched together with one request
 subnet_zone = 'b'                                               # Choices: a-c
 use_elastic_ip = False
+spot = False                                                    # Launch spot instances with an EC2 Fleet, the zone (instead of subnet_zone) and instance types are chosen by spot price
+elastic_ip_pool = 'default'                                     # Elastic IPs are allocated ahead of the launch, tagged with this pool name and reused
+elastic_ip_pool_size = 0                                        # Free addresses kept allocated for later launches (free addresses are billed)
+wait_until_ready = True                                         # Wait until the software has been installed and the instance has restarted
+ready_timeout = 1200                                            # Seconds to wait for the software installs before giving up
+ready_poll_interval = 5                                         # Seconds between the first readiness checks, backs off from here
+ready_poll_max_interval = 30
+state_poll_interval = 1                                         # Seconds between the first instance state checks (e.g. pending -> running), backs off from here
+state_poll_max_interval = 15
+state_timeout = 600                                             # Seconds to wait for instances to start, stop or take their Elastic IPs
+use_baked_images = True                                         # Launch from an image baked earlier with the same software, if there is one
+bake_image = False                                              # Install the software once and save it as an image (or run with --bake)
+###############################################################################
+# WARM POOL SETTINGS
+###############################################################################
+warm_pool_size = 0                                              # Instances kept set up and stopped for these settings, started instead of launched (run with --fill-warm-pool to fill it)
+warm_pool_idle = 'stop'                                         # Options: 'stop', 'hibernate' (keeps memory, needs encrypt_volume = True)
+warm_pool_max_age = 604800                                      # Seconds a pooled instance is kept before it is replaced, None keeps it
+warm_pool_match_ignore = []                                     # Settings a pooled instance may differ in, e.g. ['subnet_zone']
+###############################################################################
+# SPOT SETTINGS
+###############################################################################
+spot_diversity = 5                                              # Instance types the spot fleet may use, best price per vCPU and GiB first
+spot_on_demand_fallback = True                                  # Launch on-demand instances for any capacity spot can't provide
 ###############################################################################
 # VOLUME SETTINGS
 ###############################################################################
@@ -65,3 +110,18 @@ custom_rule_list = [['0.0.0.0', 80], ['0.0.0.0', 443]]          # Structure: Lis
 ###############################################################################
 create_keypair = False
 existing_key_name = 'keypair'                                   # Don't include .pem, just type the name here
+###############################################################################
+# FLEET SETTINGS
+###############################################################################
+# To launch several instances in one run, list one dict per instance. Each dict
+# may override any of the INSTANCE, VOLUME, SOFTWARE, SECURITY GROUP or KEYPAIR
+# settings above; anything left out uses the value above. For example:
+# fleet = [{'instance_type': 't3.small', 'instance_count': 4},
+#          {'instance_type': 't3.large', 'subnet_zone': 'a', 'software_selections': '1, 5'}]
+# Entries with identical settings are merged and launched together.
+fleet = None                                                    # None launches a single instance from the settings above
+fleet_max_workers = 8                                           # Maximum number of instances provisioned at the same time (per region)
+###############################################################################
+# MULTI-REGION SETTINGS
+###############################################################################
+regions = None                                                  # e.g. ['us-east-1', 'us-east-2', 'eu-west-2'] to deploy the same instance(s) to each region in parallel
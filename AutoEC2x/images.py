@@ -0,0 +1,49 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import os
+import sqlite3
+import threading
+import time
+from autoec2_common.cache import default_cache_path
+
+
+def default_registry_path():
+    return os.path.join(os.path.dirname(default_cache_path()), 'images.sqlite3')
+
+
+class ImageRegistry:
+    """Local record of baked AMIs keyed by region, base image and the hash of the install user data"""
+
+    def __init__(self, path=None):
+        self.path = path or default_registry_path()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS images (region TEXT, base_image TEXT, install_hash TEXT, '
+                                 'image_id TEXT, created REAL, PRIMARY KEY (region, base_image, install_hash))')
+        self._connection.commit()
+
+    def get(self, region, base_image, install_hash):
+        """Return the baked image ID, or None if nothing has been baked for this combination"""
+        with self._lock:
+            row = self._connection.execute('SELECT image_id FROM images WHERE region=? AND base_image=? '
+                                           'AND install_hash=?', (region, base_image, install_hash)).fetchone()
+        return row[0] if row else None
+
+    def set(self, region, base_image, install_hash, image_id):
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)',
+                                     (region, base_image, install_hash, image_id, time.time()))
+            self._connection.commit()
+        return None
+
+    def remove(self, region, base_image, install_hash):
+        with self._lock:
+            self._connection.execute('DELETE FROM images WHERE region=? AND base_image=? AND install_hash=?',
+                                     (region, base_image, install_hash))
+            self._connection.commit()
+        return None
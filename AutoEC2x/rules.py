@@ -0,0 +1,79 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import ipaddress
+
+ALL_PORTS = (-1, -1)
+
+
+def count_rules(security_group_rules):
+    """AWS counts one rule per CIDR (or group) in each permission"""
+    return sum(len(rule.get('IpRanges', [])) + len(rule.get('UserIdGroupPairs', [])) for rule in security_group_rules)
+
+
+def merge_port_ranges(port_ranges):
+    """Merge overlapping and adjacent (from, to) port ranges"""
+    merged = []
+    for from_port, to_port in sorted(port_ranges):
+        if merged and from_port <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], to_port))
+        else:
+            merged.append((from_port, to_port))
+    return merged
+
+
+def covers(broader, entry):
+    """True if <broader> allows every address and port that <entry> allows"""
+    (protocol, network, ports), (other_protocol, other_network, other_ports) = broader, entry
+    if broader == entry or network.version != other_network.version or not other_network.subnet_of(network):
+        return False
+    if protocol == '-1':
+        return True
+    return protocol == other_protocol and ports[0] <= other_ports[0] and other_ports[1] <= ports[1]
+
+
+def compact_rules(security_group_rules):
+    """Rewrite the rules as the fewest permissions that allow the same traffic
+
+    CIDRs are merged per protocol and port range with ipaddress.collapse_addresses, adjacent ports become one range
+    and entries a broader entry already allows are dropped. Rules without IpRanges (e.g. group pairs) are kept as-is.
+    """
+    entries = set()
+    passthrough = []
+    for rule in security_group_rules:
+        if set(rule) - {'IpProtocol', 'FromPort', 'ToPort', 'IpRanges'}:
+            passthrough.append(rule)
+            continue
+        protocol = str(rule['IpProtocol'])
+        ports = ALL_PORTS if protocol == '-1' else (rule['FromPort'], rule['ToPort'])
+        for ip_range in rule['IpRanges']:
+            entries.add((protocol, ipaddress.ip_network(ip_range['CidrIp'], strict=False), ports))
+
+    """Drop entries that a broader network, port range or all-traffic rule already allows"""
+    entries = [entry for entry in entries if not any(covers(other, entry) for other in entries)]
+
+    """Merge the port ranges of each network, then collapse the networks sharing a range"""
+    port_ranges = {}
+    for protocol, network, ports in entries:
+        port_ranges.setdefault((protocol, network), []).append(ports)
+    networks = {}
+    for (protocol, network), ranges in port_ranges.items():
+        for ports in merge_port_ranges(ranges):
+            networks.setdefault((protocol, ports), []).append(network)
+
+    compacted = []
+    for (protocol, (from_port, to_port)), range_networks in sorted(networks.items()):
+        cidrs = []
+        for version in (4, 6):
+            version_networks = [network for network in range_networks if network.version == version]
+            cidrs.extend(str(network) for network in ipaddress.collapse_addresses(version_networks))
+        compacted.append({
+            'IpProtocol': protocol,
+            'FromPort': from_port,
+            'ToPort': to_port,
+            'IpRanges': [{'CidrIp': cidr} for cidr in cidrs]
+        })
+    return compacted + passthrough
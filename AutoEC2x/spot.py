@@ -0,0 +1,61 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+from datetime import datetime, timezone
+import numpy as np
+
+PRODUCT_DESCRIPTIONS = ['Linux/UNIX', 'Linux/UNIX (Amazon VPC)']
+
+
+def spot_prices(ec2_client, instance_types, availability_zones):
+    """Return the current Linux spot price of each instance type in each of <availability_zones>
+
+    The result is three aligned arrays (instance types, zones, prices), one entry per offer.
+    """
+    paginator = ec2_client.get_paginator('describe_spot_price_history')
+    latest = {}
+    """A StartTime of now returns only the price in effect now for each type and zone"""
+    for page in paginator.paginate(InstanceTypes=list(instance_types), ProductDescriptions=PRODUCT_DESCRIPTIONS,
+                                   StartTime=datetime.now(timezone.utc)):
+        for record in page['SpotPriceHistory']:
+            if record['AvailabilityZone'] not in availability_zones:
+                continue
+            offer = (record['InstanceType'], record['AvailabilityZone'])
+            if offer not in latest or record['Timestamp'] > latest[offer][1]:
+                latest[offer] = (float(record['SpotPrice']), record['Timestamp'])
+    offers = sorted(latest)
+    return (np.array([instance_type for instance_type, zone in offers], dtype=str),
+            np.array([zone for instance_type, zone in offers], dtype=str),
+            np.array([latest[offer][0] for offer in offers], dtype=np.float64))
+
+
+def score_offers(prices, vcpus, memory_gib):
+    """Lower is better: price per vCPU plus price per GiB, each relative to the median offer so neither dominates"""
+    per_vcpu = prices / vcpus
+    per_gib = prices / memory_gib
+    return per_vcpu / np.median(per_vcpu) + per_gib / np.median(per_gib)
+
+
+def plan_spot_fleet(catalog, instance_types, zones, prices, diversity=5, preference=None):
+    """Pick the zone and the <diversity> instance types to request, best scoring first
+
+    Each zone is judged on the mean score of its <diversity> best offers, so the fleet goes where several good
+    instance types are cheap rather than where a single one is. Equal scores are ordered by <preference>.
+    """
+    if not len(prices):
+        raise ValueError("No spot prices for the candidate instance types")
+    rows = np.searchsorted(catalog.names, instance_types)
+    scores = score_offers(prices, catalog.columns['vcpus'][rows], catalog.columns['memory_mib'][rows] / 1024)
+
+    unique_zones = np.unique(zones)
+    zone_scores = [np.sort(scores[zones == zone])[:diversity].mean() for zone in unique_zones]
+    best_zone = unique_zones[int(np.argmin(zone_scores))]
+    in_zone = np.flatnonzero(zones == best_zone)
+    preference = list(preference or sorted(set(instance_types)))
+    ranks = np.array([preference.index(instance_type) for instance_type in instance_types[in_zone]])
+    order = in_zone[np.lexsort((ranks, scores[in_zone]))][:diversity]
+    return str(best_zone), [{'InstanceType': str(instance_types[i]), 'SpotPrice': float(prices[i]),
+                             'Score': round(float(scores[i]), 3)} for i in order]
@@ -0,0 +1,167 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import threading
+import time
+
+THROTTLE_CODES = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+                  'RequestThrottledException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                  'EC2ThrottledException', 'SlowDown', 'PriorRequestNotComplete'}
+
+
+def operation_name(event_name):
+    """'after-call.ec2.DescribeInstances' -> 'ec2.DescribeInstances'"""
+    return event_name.split('.', 1)[1]
+
+
+def critical_path(spans):
+    """Return the chain of spans that decided how long a run took, last one first
+
+    Starting from the span that ended last, each step goes back to the span that ended latest before the current
+    one started. Spans nested in or overlapping the current one ran alongside it, so they are not on the path.
+    """
+    path = []
+    remaining = sorted(spans, key=lambda span: span['end'])
+    while remaining:
+        path.append(remaining.pop())
+        remaining = [span for span in remaining if span['end'] <= path[-1]['start']]
+    return path
+
+
+class Timeline:
+    """Records when each provisioning phase ran and what every AWS API call cost
+
+    Phases are spans (start and end in seconds from the start of the run) labelled with e.g. the region. API calls
+    are counted per operation from botocore's events by an ApiRecorder.
+    """
+
+    def __init__(self):
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self.spans = []
+        self.api = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.spans.append(dict(labels, phase=phase, start=round(start - self._start, 3),
+                                       end=round(end - self._start, 3), seconds=round(end - start, 3)))
+
+    def _operation(self, name):
+        if name not in self.api:
+            self.api[name] = {'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'seconds': 0.0,
+                              'max_seconds': 0.0}
+        return self.api[name]
+
+    def record_call(self, name, seconds, retries=0, error=False):
+        with self._lock:
+            operation = self._operation(name)
+            operation['calls'] += 1
+            operation['errors'] += int(error)
+            operation['retries'] += retries
+            operation['seconds'] += seconds
+            operation['max_seconds'] = max(operation['max_seconds'], seconds)
+        return None
+
+    def record_throttle(self, name):
+        with self._lock:
+            self._operation(name)['throttles'] += 1
+        return None
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+            api = {name: dict(operation, seconds=round(operation['seconds'], 3),
+                              max_seconds=round(operation['max_seconds'], 3))
+                   for name, operation in sorted(self.api.items())}
+        phases = {}
+        for span in spans:
+            phases[span['phase']] = round(phases.get(span['phase'], 0) + span['seconds'], 3)
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'seconds': round(time.perf_counter() - self._start, 3),
+            'spans': spans,
+            'phase_seconds': phases,
+            'api_calls': sum(operation['calls'] for operation in api.values()),
+            'api': api,
+        }
+
+    def save(self, path):
+        """Append the timeline to <path> as one JSON line, so runs can be compared over time"""
+        with open(path, 'a') as timeline_file:
+            timeline_file.write(json.dumps(self.to_dict()) + '\n')
+        return None
+
+
+class ApiRecorder:
+    """botocore event handlers that report every API call to the timelines currently recording
+
+    Handlers can only be added to a session before its clients are created, so one recorder is registered per
+    session and timelines are added and removed as runs start and finish. Runs sharing a session at the same
+    time see each other's calls.
+    """
+
+    def __init__(self):
+        self.timelines = set()
+        self._lock = threading.Lock()
+
+    def register(self, events):
+        events.register('before-call', self.before_call)
+        events.register('after-call', self.after_call)
+        events.register('after-call-error', self.after_call_error)
+        events.register('needs-retry', self.needs_retry)
+        return None
+
+    @contextmanager
+    def recording(self, timeline):
+        with self._lock:
+            self.timelines.add(timeline)
+        try:
+            yield timeline
+        finally:
+            with self._lock:
+                self.timelines.discard(timeline)
+
+    def _timelines(self):
+        with self._lock:
+            return list(self.timelines)
+
+    def before_call(self, context=None, **kwargs):
+        if context is not None:
+            context['mml_api_start'] = time.perf_counter()
+        return None
+
+    def after_call(self, event_name, parsed=None, context=None, **kwargs):
+        """Emitted once per call, after any retries, for successful calls and for error responses"""
+        seconds = max(time.perf_counter() - (context or {}).get('mml_api_start', time.perf_counter()), 0.0)
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        for timeline in self._timelines():
+            timeline.record_call(operation_name(event_name), seconds, retries, error='Error' in (parsed or {}))
+        return None
+
+    def after_call_error(self, event_name, context=None, **kwargs):
+        """Emitted instead of after-call when no response could be read, e.g. connection errors"""
+        seconds = max(time.perf_counter() - (context or {}).get('mml_api_start', time.perf_counter()), 0.0)
+        for timeline in self._timelines():
+            timeline.record_call(operation_name(event_name), seconds, error=True)
+        return None
+
+    def needs_retry(self, event_name, response=None, **kwargs):
+        """Emitted for every attempt, so each throttled attempt is counted"""
+        if response is None or response[1].get('Error', {}).get('Code') not in THROTTLE_CODES:
+            return None
+        for timeline in self._timelines():
+            timeline.record_throttle(operation_name(event_name))
+        return None
@@ -0,0 +1,271 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import gzip
+import hashlib
+import re
+import shlex
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+"""EC2 rejects user data over 16 KB, the limit applies to the compressed document"""
+USER_DATA_LIMIT = 16384
+MIME_BOUNDARY = '==MML-AUTOEC2X-USERDATA=='
+STEPS_DIRECTORY = '/var/lib/mml-autoec2/steps'
+
+"""Each topping is described by what it needs rather than as a script, so the compiler can batch the apt work
+and run independent steps at the same time. <requires> lists the toppings whose post-install steps must run first"""
+BASE = {
+    'keys': [],
+    'repos': [],
+    'packages': ['python3-pip', 'python3.8-venv', 'pigz', 'awscli'],
+    'services': [],
+    'post': ['pip3 install virtualenv'],
+}
+TOPPINGS = {
+    'Postgres': {
+        'number': 1,
+        'keys': ['wget --quiet -O - https://www.postgresql.org/media/keys/ACCC4CF8.asc | apt-key add -'],
+        'repos': ['echo "deb http://apt.postgresql.org/pub/repos/apt $(lsb_release -cs)-pgdg main" '
+                  '> /etc/apt/sources.list.d/pgdg.list'],
+        'packages': ['postgresql-14'],
+        'services': ['postgresql'],
+    },
+    'MongoDB': {
+        'number': 2,
+        'keys': ['wget -qO - https://www.mongodb.org/static/pgp/server-5.0.asc | apt-key add -'],
+        'repos': ['echo "deb [ arch=amd64,arm64 ] https://repo.mongodb.org/apt/ubuntu focal/mongodb-org/5.0 multiverse" '
+                  '| tee /etc/apt/sources.list.d/mongodb-org-5.0.list'],
+        'packages': ['gnupg', 'mongodb-org'],
+        'services': ['mongod'],
+    },
+    'MySQL': {
+        'number': 3,
+        'packages': ['mysql-server'],
+        'services': ['mysql'],
+    },
+    'sqlite3': {
+        'number': 4,
+        'packages': ['sqlite3'],
+    },
+    'Redis': {
+        'number': 5,
+        'packages': ['redis-server'],
+        'services': ['redis-server'],
+    },
+    'Docker': {
+        'number': 6,
+        'keys': ['curl -fsSL https://download.docker.com/linux/ubuntu/gpg '
+                 '| gpg --dearmor -o /usr/share/keyrings/docker-archive-keyring.gpg'],
+        'repos': ['echo "deb [arch=$(dpkg --print-architecture) signed-by=/usr/share/keyrings/docker-archive-keyring.gpg] '
+                  'https://download.docker.com/linux/ubuntu $(lsb_release -cs) stable" '
+                  '| tee /etc/apt/sources.list.d/docker.list > /dev/null'],
+        'packages': ['ca-certificates', 'curl', 'gnupg', 'lsb-release', 'docker-ce', 'docker-ce-cli', 'containerd.io'],
+        'services': ['docker'],
+    },
+    'Git': {
+        'number': 7,
+        'packages': ['git-all'],
+    },
+    'Nginx': {
+        'number': 8,
+        'packages': ['nginx'],
+        'services': ['nginx'],
+    },
+    'Caddy': {
+        'number': 9,
+        'keys': ["curl -1sLf 'https://dl.cloudsmith.io/public/caddy/stable/gpg.key' "
+                 "| tee /etc/apt/trusted.gpg.d/caddy-stable.asc"],
+        'repos': ["curl -1sLf 'https://dl.cloudsmith.io/public/caddy/stable/debian.deb.txt' "
+                  "| tee /etc/apt/sources.list.d/caddy-stable.list"],
+        'packages': ['debian-keyring', 'debian-archive-keyring', 'apt-transport-https', 'caddy'],
+        'services': ['caddy'],
+    },
+    'Apache': {
+        'number': 10,
+        'packages': ['apache2'],
+        'services': ['apache2'],
+    },
+    'NodeJS': {
+        'number': 11,
+        'packages': ['nodejs', 'npm'],
+    },
+    'Airflow': {
+        'number': 12,
+        'packages': ['libmysqlclient-dev', 'libssl-dev', 'libkrb5-dev'],
+        'requires': ['base'],
+        'post': ['virtualenv airflow_idroot', 'cd airflow_idroot/', 'source bin/activate',
+                 'export AIRFLOW_HOME=~/airflow', 'pip3 install apache-airflow', 'pip3 install typing_extensions', 'airflow db init',
+                 # The webserver never exits, so it runs as a service instead of holding up the install
+                 'printf "[Unit]\\nDescription=Airflow webserver\\nAfter=network.target\\n[Service]\\n'
+                 'Environment=AIRFLOW_HOME=%s\\nExecStart=%s webserver -p 8080\\nRestart=on-failure\\n[Install]\\n'
+                 'WantedBy=multi-user.target\\n" "$AIRFLOW_HOME" "$(command -v airflow)" '
+                 '> /etc/systemd/system/airflow-webserver.service',
+                 'systemctl daemon-reload', 'systemctl enable --now airflow-webserver'],
+    },
+}
+SOFTWARE_NUMBERS = {topping['number']: name for name, topping in TOPPINGS.items()}
+
+
+def parse_toppings(toppings_selection):
+    """Return the topping names for a selection such as '1, 5, 7, 9', 'all' or None"""
+    if toppings_selection is None:
+        return []
+    if toppings_selection == 'all':
+        return list(TOPPINGS)
+    return unique(SOFTWARE_NUMBERS[int(i)] for i in re.findall(r'\d+', toppings_selection))
+
+
+def unique(items):
+    return list(dict.fromkeys(items))
+
+
+def shell_part(name, lines):
+    return {'name': name, 'content_type': 'x-shellscript', 'content': '\n'.join(['#!/bin/bash'] + lines) + '\n'}
+
+
+def install_steps(toppings):
+    """Return the install DAG as (step, prerequisites, commands), every step listed after its prerequisites
+
+    Keys and repos of different toppings don't depend on each other, so they can all be fetched at once. The apt
+    steps form one chain, and services and post-install steps only wait for the packages and what they require.
+    """
+    steps = []
+    repo_steps = []
+    for name, topping in [('base', BASE)] + [(name, TOPPINGS[name]) for name in toppings]:
+        step_name = name.lower()
+        if topping.get('keys'):
+            steps.append((f'key-{step_name}', [], topping['keys']))
+        if topping.get('repos'):
+            steps.append((f'repo-{step_name}', [f'key-{step_name}'] if topping.get('keys') else [], topping['repos']))
+            repo_steps.append(f'repo-{step_name}')
+
+    packages = unique(package for topping in [BASE] + [TOPPINGS[name] for name in toppings]
+                      for package in topping.get('packages', []))
+    """apt waits for dpkg's lock (e.g. held by unattended-upgrades at first boot) instead of failing"""
+    apt_get = 'apt-get -y -o DPkg::Lock::Timeout=600'
+    steps.append(('apt-update', repo_steps, [f'{apt_get} update']))
+    steps.append(('apt-upgrade', ['apt-update'], [f'{apt_get} upgrade']))
+    steps.append(('apt-install', ['apt-upgrade'], [f'{apt_get} install {" ".join(packages)}']))
+
+    for name, topping in [('base', BASE)] + [(name, TOPPINGS[name]) for name in toppings]:
+        step_name = name.lower()
+        for service in topping.get('services', []):
+            steps.append((f'service-{service}', ['apt-install'], [f'systemctl start {service}']))
+        if topping.get('post'):
+            requires = [f'post-{required.lower()}' for required in topping.get('requires', [])]
+            steps.append((f'post-{step_name}', ['apt-install'] + requires, topping['post']))
+    return steps
+
+
+def installer_part(toppings):
+    """Render the install DAG as a script, each step starts as soon as its prerequisites have finished"""
+    lines = [
+        'export DEBIAN_FRONTEND=noninteractive',
+        f'steps={STEPS_DIRECTORY}',
+        'mkdir -p $steps',
+        '#',
+        '#run_step <step> <prerequisites> <commands>, the time each step takes is logged to $steps/timings.log',
+        '#A step fails on its first failing command (or pipe), it leaves $steps/<step>.failed instead of .done',
+        '#and the steps that need it are skipped',
+        'run_step() {',
+        '    local dep start status',
+        '    for dep in $2; do',
+        '        until [ -e "$steps/$dep.done" ] || [ -e "$steps/$dep.failed" ]; do sleep 0.2; done',
+        '        if [ -e "$steps/$dep.failed" ]; then',
+        '            echo "$1 skipped=$dep" >> "$steps/timings.log"',
+        '            touch "$steps/$1.failed"',
+        '            return',
+        '        fi',
+        '    done',
+        '    start=$(date +%s.%N)',
+        '    bash -eo pipefail -c "$3" > "$steps/$1.log" 2>&1',
+        '    status=$?',
+        '    echo "$1 exit=$status seconds=$(awk "BEGIN {print $(date +%s.%N) - $start}")" >> "$steps/timings.log"',
+        '    if [ $status -eq 0 ]; then touch "$steps/$1.done"; else touch "$steps/$1.failed"; fi',
+        '}',
+        '#',
+    ]
+    for step, prerequisites, commands in install_steps(toppings):
+        lines.append(f"run_step {step} {shlex.quote(' '.join(prerequisites))} {shlex.quote(chr(10).join(commands))} &")
+    lines += ['wait']
+    return shell_part('00-install.sh', lines)
+
+
+def install_hash(toppings):
+    """Identifies what the install part puts on an instance, so a baked image can stand in for it"""
+    return hashlib.sha256(installer_part(toppings)['content'].encode('utf-8')).hexdigest()[:16]
+
+
+def compile_userdata(toppings, custom_userdata=None, ready_marker=None, baked=False, failed_marker=None):
+    """Compile the install steps for <toppings> and <custom_userdata> into cloud-init parts, run in list order
+
+    Every package comes from a single, non-interactive apt transaction after a single index refresh, instead of
+    each topping updating the index and installing on its own. A <baked> image already has the software, so only
+    the custom userdata runs and the instance is ready without the restart. If an install step failed, the
+    instance isn't restarted and <failed_marker> is written with the failed steps instead of <ready_marker>.
+    """
+    parts = [] if baked else [installer_part(toppings)]
+
+    """Add custom userdata, as cloud-config if it is one and as a script otherwise"""
+    if custom_userdata is not None:
+        if custom_userdata.startswith('#cloud-config'):
+            parts.append({'name': '90-custom.cfg', 'content_type': 'cloud-config', 'content': custom_userdata})
+        elif custom_userdata.startswith('#!'):
+            parts.append({'name': '90-custom.sh', 'content_type': 'x-shellscript', 'content': custom_userdata})
+        else:
+            parts.append(shell_part('90-custom.sh', [custom_userdata.rstrip('\n')]))
+
+    if baked:
+        if ready_marker is not None:
+            parts.append(shell_part('99-finish.sh', ['#Signal completion on the serial console',
+                                                     f'echo {ready_marker} > /dev/console']))
+        return parts
+
+    """Restart instance after installing software"""
+    lines = ['#Restart', 'shutdown -r now']
+    if ready_marker is not None:
+        lines = ['#Signal completion on the serial console once the instance is back up',
+                 f'echo "@reboot root echo {ready_marker} > /dev/console; rm -f /etc/cron.d/mml-autoec2-ready" '
+                 f'> /etc/cron.d/mml-autoec2-ready', '#'] + lines
+    """A failed install is reported right away, the instance is left as it is for the step logs to be read"""
+    failed_lines = [f'failed=$(cd {STEPS_DIRECTORY} && ls *.failed 2>/dev/null | sed "s/\\.failed$//" | tr "\\n" " ")',
+                    'if [ -n "$failed" ]; then']
+    if failed_marker is not None:
+        failed_lines.append(f'    echo "{failed_marker} $failed" > /dev/console')
+    failed_lines += ['    exit 1', 'fi', '#']
+    parts.append(shell_part('99-finish.sh', ['#Check the install steps'] + failed_lines + lines))
+    return parts
+
+
+def encode_userdata(parts):
+    """Build the gzip compressed multipart MIME document, cloud-init decompresses it before reading the parts"""
+    message = MIMEMultipart()
+    message.set_boundary(MIME_BOUNDARY)
+    for part in parts:
+        attachment = MIMEText(part['content'], part['content_type'], 'utf-8')
+        attachment.add_header('Content-Disposition', 'attachment', filename=part['name'])
+        message.attach(attachment)
+    return gzip.compress(message.as_bytes(), mtime=0)
+
+
+def userdata_size(parts, user_data, limit=USER_DATA_LIMIT):
+    """Report the user data size against EC2's limit, with what each part adds when compressed on its own"""
+    return {
+        'bytes': len(user_data),
+        'limit': limit,
+        'parts': {part['name']: len(gzip.compress(part['content'].encode('utf-8'), mtime=0)) for part in parts},
+    }
+
+
+def check_userdata_size(size):
+    """Raise before launching rather than letting run_instances fail on oversized user data"""
+    if size['bytes'] > size['limit']:
+        largest = sorted(size['parts'].items(), key=lambda item: item[1], reverse=True)
+        details = ', '.join(f'{name}: {compressed:,}' for name, compressed in largest)
+        raise ValueError(f"User data is {size['bytes']:,} bytes compressed, over the {size['limit']:,} byte limit "
+                         f"(compressed bytes per part: {details})")
+    return None
@@ -0,0 +1,115 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import threading
+import time
+from botocore import exceptions as bc
+
+POOL_TAG = 'mml-autoec2:address-pool'
+"""Association errors that clear up on their own: the instance isn't running yet, or the instance or a new
+allocation isn't visible to associate_address yet"""
+RETRY_ERRORS = {'IncorrectInstanceState', 'InvalidInstanceID', 'InvalidInstanceID.NotFound',
+                'InvalidAllocationID.NotFound'}
+
+
+class AddressPool:
+    """Elastic IPs allocated ahead of time and tagged with the pool's <name>, handed out as instances need them
+
+    Addresses stay allocated when their instance is torn down and go back to the pool for the next launch. Free
+    addresses are billed, so drain() releases the ones beyond what should be kept.
+    """
+
+    def __init__(self, ec2_client, name='default', dry_run=False):
+        self.ec2_client = ec2_client
+        self.name = name
+        self.dry_run = dry_run
+        self._free = None
+        self._lock = threading.Lock()
+
+    def describe(self, instance_ids=None):
+        filters = [{'Name': f'tag:{POOL_TAG}', 'Values': [self.name]}]
+        if instance_ids is not None:
+            filters.append({'Name': 'instance-id', 'Values': list(instance_ids)})
+        return self.ec2_client.describe_addresses(Filters=filters)['Addresses']
+
+    def _load(self):
+        if self._free is None:
+            self._free = [address for address in self.describe()
+                          if not address.get('AssociationId') and not address.get('NetworkInterfaceId')]
+        return self._free
+
+    def allocate(self):
+        address = self.ec2_client.allocate_address(
+            Domain='vpc',
+            TagSpecifications=[{'ResourceType': 'elastic-ip', 'Tags': [{'Key': POOL_TAG, 'Value': self.name}]}],
+            DryRun=self.dry_run
+        )
+        return {'AllocationId': address['AllocationId'], 'PublicIp': address['PublicIp']}
+
+    def fill(self, count):
+        """Allocate addresses until at least <count> are free"""
+        with self._lock:
+            missing = count - len(self._load())
+        for _ in range(missing):
+            address = self.allocate()
+            with self._lock:
+                self._free.append(address)
+        return None
+
+    def acquire(self, allocate=True):
+        """Take a free address, only allocating one when the pool is empty (or returning None if not <allocate>)"""
+        with self._lock:
+            free = self._load()
+            if free:
+                address = free.pop(0)
+                return {'AllocationId': address['AllocationId'], 'PublicIp': address['PublicIp']}
+        return self.allocate() if allocate else None
+
+    def associate(self, instance_id, address=None, attempts=8, delay=0.5):
+        """Associate <address> (or a pooled one) with <instance_id>, retrying with backoff while it can't work yet
+
+        An address another run associated in the meantime is skipped for the next free one.
+        """
+        address = address or self.acquire()
+        for attempt in range(attempts):
+            try:
+                self.ec2_client.associate_address(
+                    AllocationId=address['AllocationId'],
+                    InstanceId=instance_id,
+                    AllowReassociation=False,
+                    DryRun=self.dry_run
+                )
+                return address
+            except bc.ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'Resource.AlreadyAssociated':
+                    address = self.acquire()
+                elif code not in RETRY_ERRORS or attempt == attempts - 1:
+                    raise
+                else:
+                    time.sleep(delay * 2 ** attempt)
+        raise RuntimeError(f"No free Elastic IP could be associated with instance {instance_id}")
+
+    def release(self, instance_ids):
+        """Disassociate the pool's addresses from <instance_ids> and return them to the pool"""
+        with self._lock:
+            self._load()
+        addresses = self.describe(instance_ids)
+        for address in addresses:
+            self.ec2_client.disassociate_address(AssociationId=address['AssociationId'], DryRun=self.dry_run)
+        with self._lock:
+            self._free.extend({'AllocationId': address['AllocationId'], 'PublicIp': address['PublicIp']}
+                              for address in addresses)
+        return [address['PublicIp'] for address in addresses]
+
+    def drain(self, keep=0):
+        """Release the free addresses beyond <keep>"""
+        with self._lock:
+            free = self._load()
+            released, self._free = free[keep:], free[:keep]
+        for address in released:
+            self.ec2_client.release_address(AllocationId=address['AllocationId'], DryRun=self.dry_run)
+        return [address['PublicIp'] for address in released]
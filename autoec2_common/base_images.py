@@ -0,0 +1,39 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+from botocore import exceptions as bc
+
+"""Canonical publishes the current Ubuntu 20.04 LTS image of every region as a public SSM parameter"""
+UBUNTU_PARAMETER = '/aws/service/canonical/ubuntu/server/20.04/stable/current/{architecture}/hvm/ebs-gp2/ami-id'
+UBUNTU_OWNER = '099720109477'
+UBUNTU_NAME = 'ubuntu/images/hvm-ssd/ubuntu-focal-20.04-{architecture}-server-*'
+UBUNTU_ARCHITECTURES = {'x86_64': 'amd64', 'arm64': 'arm64'}
+
+
+def instance_architecture(supported_architectures):
+    """Pick the image architecture for an instance type, x86_64 unless it only runs arm64"""
+    if 'arm64' in supported_architectures and 'x86_64' not in supported_architectures:
+        return 'arm64'
+    return 'x86_64'
+
+
+def find_base_image(clients, region, architecture='x86_64'):
+    """Return the current Ubuntu 20.04 image in <region>, from the SSM parameter or a filtered describe_images"""
+    ubuntu_architecture = UBUNTU_ARCHITECTURES[architecture]
+    try:
+        parameter = clients.client('ssm', region).get_parameter(
+            Name=UBUNTU_PARAMETER.format(architecture=ubuntu_architecture))
+        return parameter['Parameter']['Value']
+    except (bc.ClientError, bc.BotoCoreError):
+        """e.g. no ssm:GetParameter permission, search Canonical's images instead"""
+        images = clients.client('ec2', region).describe_images(
+            Owners=[UBUNTU_OWNER],
+            Filters=[{'Name': 'name', 'Values': [UBUNTU_NAME.format(architecture=ubuntu_architecture)]},
+                     {'Name': 'architecture', 'Values': [architecture]},
+                     {'Name': 'state', 'Values': ['available']}])['Images']
+    if not images:
+        raise ValueError(f"No Ubuntu 20.04 image for {architecture} in {region}")
+    return max(images, key=lambda image: image['CreationDate'])['ImageId']
@@ -0,0 +1,96 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+"""Seconds each cached call stays fresh, regions and instance types almost never change
+Calls named '<call>:<detail>' (e.g. 'base_image:arm64') use the TTL of <call>"""
+DEFAULT_TTLS = {
+    'get_caller_identity': 24 * 60 * 60,
+    'describe_regions': 7 * 24 * 60 * 60,
+    'describe_instance_types': 24 * 60 * 60,
+    'describe_subnets': 60 * 60,
+    'describe_vpcs': 60 * 60,
+    'describe_security_groups': 10 * 60,
+    'instance_architecture': 7 * 24 * 60 * 60,
+    'base_image': 24 * 60 * 60,
+}
+
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'mml-autoec2', 'metadata.sqlite3')
+
+
+def credentials_fingerprint(credentials):
+    """Key for caching the identity lookup itself, so the account is known without calling STS"""
+    return hashlib.sha256(credentials.access_key.encode('utf-8')).hexdigest()[:16]
+
+
+class MetadataCache:
+    """On-disk cache of EC2 discovery calls keyed by account, region and call, with a TTL per entry"""
+
+    def __init__(self, path=None, refresh=False, enabled=True, ttls=None):
+        self.path = path or default_cache_path()
+        self.refresh = refresh
+        self.enabled = enabled
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self._lock = threading.Lock()
+        self._connection = None
+        if self.enabled:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS entries (account TEXT, region TEXT, call TEXT, '
+                                     'expires REAL, value TEXT, PRIMARY KEY (account, region, call))')
+            self._connection.commit()
+
+    def get(self, account, region, call):
+        """Return the cached value, or None if it is missing or expired"""
+        if not self.enabled or self.refresh:
+            return None
+        with self._lock:
+            row = self._connection.execute('SELECT expires, value FROM entries WHERE account=? AND region=? AND call=?',
+                                           (account, region, call)).fetchone()
+        if row is None or row[0] < time.time():
+            return None
+        return json.loads(row[1])
+
+    def set(self, account, region, call, value, ttl=None):
+        if not self.enabled:
+            return None
+        expires = time.time() + (ttl if ttl is not None else self.ttls[call.split(':')[0]])
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                                     (account, region, call, expires, json.dumps(value, default=str)))
+            self._connection.commit()
+        return None
+
+    def fetch(self, account, region, call, loader, ttl=None):
+        """Return the cached value for <call>, calling <loader> and storing its result on a miss"""
+        value = self.get(account, region, call)
+        if value is None:
+            value = loader()
+            self.set(account, region, call, value, ttl)
+        return value
+
+    def invalidate(self, account=None, region=None, call=None):
+        """Drop every entry matching the given account/region/call, or all entries if none are given"""
+        if not self.enabled:
+            return None
+        clauses = [(column, value) for column, value in (('account', account), ('region', region), ('call', call))
+                   if value is not None]
+        where = ' AND '.join(f'{column}=?' for column, value in clauses) or '1=1'
+        with self._lock:
+            self._connection.execute(f'DELETE FROM entries WHERE {where}', [value for column, value in clauses])
+            self._connection.commit()
+        return None
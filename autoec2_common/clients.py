@@ -0,0 +1,48 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import threading
+import boto3
+from botocore.config import Config
+
+
+def client_config(max_pool_connections=10, tcp_keepalive=True, retry_mode='standard', max_attempts=5):
+    """Connection pool, keep-alive and retry settings shared by every client"""
+    return Config(max_pool_connections=max_pool_connections, tcp_keepalive=tcp_keepalive,
+                  retries={'mode': retry_mode, 'max_attempts': max_attempts})
+
+
+class ClientFactory:
+    """Hands out one client (or resource) per service and region, all backed by one session and Config
+
+    Clients are thread-safe and are created under a lock so concurrent callers share them. Resources are not
+    thread-safe, so a resource should only be used from one thread at a time.
+    """
+
+    def __init__(self, session=None, config=None):
+        self.session = session or boto3.session.Session()
+        self.config = config or client_config()
+        self._clients = {}
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    @property
+    def region_name(self):
+        return self.session.region_name
+
+    def client(self, service, region=None):
+        key = (service, region or self.session.region_name)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = self.session.client(service, region_name=key[1], config=self.config)
+        return self._clients[key]
+
+    def resource(self, service, region=None):
+        key = (service, region or self.session.region_name)
+        with self._lock:
+            if key not in self._resources:
+                self._resources[key] = self.session.resource(service, region_name=key[1], config=self.config)
+        return self._resources[key]
@@ -0,0 +1,152 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import threading
+import time
+
+"""describe_instances accepts up to 200 values per filter"""
+FILTER_LIMIT = 200
+"""States an instance can't come back from while waiting for <state>"""
+FAILED_STATES = {
+    'pending': {'shutting-down', 'terminated'},
+    'running': {'shutting-down', 'terminated'},
+    'stopping': {'shutting-down', 'terminated'},
+    'stopped': {'shutting-down', 'terminated'},
+    'shutting-down': set(),
+    'terminated': set(),
+}
+
+
+def in_state(state):
+    """Condition for InstancePoller.wait: the instance is in <state>, raise if it can no longer get there"""
+    if state not in FAILED_STATES:
+        raise ValueError(f"Invalid instance state: {state}")
+
+    def ready(instance_id, instance):
+        if instance is None:
+            return False
+        current = instance['State']['Name']
+        if current in FAILED_STATES[state]:
+            reason = instance.get('StateReason', {}).get('Message', 'no reason given')
+            raise RuntimeError(f"Instance {instance_id} is {current} ({reason}), expected {state}")
+        return current == state
+    ready.description = state
+    return ready
+
+
+def has_public_ips(public_ips):
+    """Condition for InstancePoller.wait: each instance reports its address in <public_ips> (instance ID: address),
+    e.g. once an Elastic IP association has taken effect"""
+    def ready(instance_id, instance):
+        return instance is not None and instance.get('PublicIpAddress') == public_ips[instance_id]
+    ready.description = 'using their Elastic IPs'
+    return ready
+
+
+class InstancePoller:
+    """Waits on many instances with one describe_instances call per tick instead of one waiter per instance
+
+    Every thread waiting on the poller shares its ticks, so groups launched at the same time in a region are
+    checked together. Polling starts at <interval> seconds and backs off to <max_interval>, and every state change
+    is recorded (and passed to <on_change>) as soon as a tick sees it.
+    """
+
+    def __init__(self, ec2_client, interval=1, max_interval=15, backoff=1.5, on_change=None):
+        self.ec2_client = ec2_client
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.on_change = on_change
+        self.instances = {}
+        self.history = {}
+        self._watched = {}
+        self._described = {}
+        self._polling = False
+        self._last_poll = 0
+        self._ticks = 0
+        self._condition = threading.Condition()
+
+    def poll(self, instance_ids):
+        """Describe <instance_ids>, filtering by ID so instances that aren't visible yet are skipped, not errors"""
+        paginator = self.ec2_client.get_paginator('describe_instances')
+        instances = {}
+        for i in range(0, len(instance_ids), FILTER_LIMIT):
+            filters = [{'Name': 'instance-id', 'Values': instance_ids[i:i + FILTER_LIMIT]}]
+            for page in paginator.paginate(Filters=filters):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        instances[instance['InstanceId']] = instance
+        return instances
+
+    def _record(self, instances):
+        now = time.time()
+        changes = []
+        for instance_id, instance in instances.items():
+            state = instance['State']['Name']
+            history = self.history.setdefault(instance_id, [])
+            if not history or history[-1][0] != state:
+                changes.append((instance_id, history[-1][0] if history else None, state))
+                history.append((state, now))
+            self.instances[instance_id] = instance
+            self._described[instance_id] = self._ticks
+        return changes
+
+    def wait(self, instance_ids, ready, timeout=600):
+        """Wait until <ready>(instance_id, instance) holds for every instance, return their latest descriptions"""
+        instance_ids = list(instance_ids)
+        deadline = time.time() + timeout
+        interval = self.interval
+        with self._condition:
+            ticks = self._ticks
+            """Descriptions from before the wait (or from a tick already under way) may predate the change waited for"""
+            first_tick = self._ticks + (1 if self._polling else 0)
+            for instance_id in instance_ids:
+                self._watched[instance_id] = self._watched.get(instance_id, 0) + 1
+        try:
+            while True:
+                with self._condition:
+                    """Back off with every tick, whichever waiter made it"""
+                    if self._ticks != ticks:
+                        interval = min(interval * self.backoff ** (self._ticks - ticks), self.max_interval)
+                        ticks = self._ticks
+                    current = {instance_id: self.instances[instance_id] for instance_id in instance_ids
+                               if self._described.get(instance_id, -1) >= first_tick}
+                    pending = [instance_id for instance_id in instance_ids
+                               if not ready(instance_id, current.get(instance_id))]
+                    if not pending:
+                        return current
+                    if time.time() > deadline:
+                        raise RuntimeError(f"Timed out waiting for instances {pending} to be "
+                                           f"{getattr(ready, 'description', 'ready')}")
+                    """Another waiter's tick covers these instances too, so wait for it instead of polling"""
+                    wait_seconds = self._last_poll + interval - time.time()
+                    if self._polling or wait_seconds > 0:
+                        self._condition.wait(timeout=max(wait_seconds, 0.05))
+                        continue
+                    self._polling = True
+                    watched = list(self._watched)
+                instances = None
+                try:
+                    instances = self.poll(watched)
+                finally:
+                    with self._condition:
+                        changes = self._record(instances) if instances is not None else []
+                        self._polling = False
+                        self._last_poll = time.time()
+                        self._ticks += 1
+                        self._condition.notify_all()
+                if self.on_change is not None:
+                    for change in changes:
+                        self.on_change(*change)
+        finally:
+            with self._condition:
+                for instance_id in instance_ids:
+                    self._watched[instance_id] -= 1
+                    if not self._watched[instance_id]:
+                        del self._watched[instance_id]
+
+    def wait_for_state(self, instance_ids, state, timeout=600):
+        return self.wait(instance_ids, in_state(state), timeout)
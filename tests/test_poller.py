@@ -0,0 +1,129 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import pytest
+from autoec2_common.poller import InstancePoller, has_public_ips, in_state
+
+
+class FakeEc2:
+    """describe_instances through a paginator, each instance moves through its list of states one poll at a time
+
+    An instance whose current state is None isn't visible yet and is left out of the response.
+    """
+
+    def __init__(self, states, public_ips=None):
+        self.states = {instance_id: list(sequence) for instance_id, sequence in states.items()}
+        self.public_ips = public_ips or {}
+        self.polls = 0
+        self.requested = []
+        self._lock = threading.Lock()
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_instances'
+        return self
+
+    def paginate(self, Filters):
+        instance_ids = Filters[0]['Values']
+        with self._lock:
+            self.polls += 1
+            self.requested.append(list(instance_ids))
+            instances = []
+            for instance_id in instance_ids:
+                sequence = self.states[instance_id]
+                state = sequence.pop(0) if len(sequence) > 1 else sequence[0]
+                if state is None:
+                    continue
+                instance = {'InstanceId': instance_id, 'State': {'Name': state}}
+                if state in ('shutting-down', 'terminated'):
+                    instance['StateReason'] = {'Message': 'Server.InsufficientInstanceCapacity'}
+                if instance_id in self.public_ips:
+                    instance['PublicIpAddress'] = self.public_ips[instance_id]
+                instances.append(instance)
+        return [{'Reservations': [{'Instances': instances}]}]
+
+
+def poller(ec2_client, **kwargs):
+    return InstancePoller(ec2_client, interval=0.01, max_interval=0.02, **kwargs)
+
+
+def test_waits_until_every_instance_is_in_the_state():
+    ec2_client = FakeEc2({'i-1': ['pending', 'running'], 'i-2': [None, 'pending', 'pending', 'running']})
+    changes = []
+    instances = poller(ec2_client, on_change=lambda *change: changes.append(change)).wait_for_state(
+        ['i-1', 'i-2'], 'running', timeout=5)
+    assert {instance_id: instance['State']['Name'] for instance_id, instance in instances.items()} == {
+        'i-1': 'running', 'i-2': 'running'}
+    """Instances that aren't visible yet are waited for, not errors, and every change is reported once"""
+    assert ('i-2', 'pending', 'running') in changes
+    assert changes.count(('i-1', None, 'pending')) == 1
+
+
+def test_history_records_each_state_once():
+    ec2_client = FakeEc2({'i-1': ['pending', 'pending', 'running']})
+    instance_poller = poller(ec2_client)
+    instance_poller.wait_for_state(['i-1'], 'running', timeout=5)
+    assert [state for state, seen in instance_poller.history['i-1']] == ['pending', 'running']
+
+
+def test_failed_state_raises_with_the_reason():
+    ec2_client = FakeEc2({'i-1': ['pending', 'shutting-down', 'terminated']})
+    with pytest.raises(RuntimeError, match='i-1 is shutting-down.*InsufficientInstanceCapacity.*expected running'):
+        poller(ec2_client).wait_for_state(['i-1'], 'running', timeout=5)
+
+
+def test_waiting_for_terminated_does_not_treat_it_as_failure():
+    ec2_client = FakeEc2({'i-1': ['running', 'shutting-down', 'terminated']})
+    instances = poller(ec2_client).wait_for_state(['i-1'], 'terminated', timeout=5)
+    assert instances['i-1']['State']['Name'] == 'terminated'
+
+
+def test_times_out_with_the_pending_instances():
+    ec2_client = FakeEc2({'i-1': ['running'], 'i-2': ['pending']})
+    with pytest.raises(RuntimeError, match=r"Timed out waiting for instances \['i-2'\] to be running"):
+        poller(ec2_client).wait_for_state(['i-1', 'i-2'], 'running', timeout=0.2)
+
+
+def test_invalid_state():
+    with pytest.raises(ValueError):
+        in_state('rebooting')
+
+
+def test_public_ip_condition():
+    ec2_client = FakeEc2({'i-1': ['running']}, public_ips={'i-1': '1.2.3.4'})
+    instances = poller(ec2_client).wait(['i-1'], has_public_ips({'i-1': '1.2.3.4'}), timeout=5)
+    assert instances['i-1']['PublicIpAddress'] == '1.2.3.4'
+    with pytest.raises(RuntimeError, match='using their Elastic IPs'):
+        poller(ec2_client).wait(['i-1'], has_public_ips({'i-1': '5.6.7.8'}), timeout=0.1)
+
+
+def test_descriptions_from_before_the_wait_are_not_trusted():
+    """A second wait must poll again rather than answer from the previous wait's (possibly stale) descriptions"""
+    ec2_client = FakeEc2({'i-1': ['running', 'running', 'stopping', 'stopped']})
+    instance_poller = poller(ec2_client)
+    instance_poller.wait_for_state(['i-1'], 'running', timeout=5)
+    polls = ec2_client.polls
+    instance_poller.wait_for_state(['i-1'], 'stopped', timeout=5)
+    assert ec2_client.polls > polls
+
+
+def test_concurrent_waiters_share_ticks():
+    states = {f'i-{n}': ['pending'] * 3 + ['running'] for n in range(6)}
+    ec2_client = FakeEc2(states)
+    instance_poller = InstancePoller(ec2_client, interval=0.05, max_interval=0.05)
+    start = threading.Barrier(3)
+
+    def wait(instance_ids):
+        start.wait()
+        return instance_poller.wait_for_state(instance_ids, 'running', timeout=5)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(wait, [['i-0', 'i-1'], ['i-2', 'i-3'], ['i-4', 'i-5']]))
+    assert all(len(result) == 2 for result in results)
+    """Each waiter alone would need 4 polls of its own instances, shared ticks describe everything together"""
+    assert ec2_client.polls < 3 * 4
+    assert any(len(requested) > 2 for requested in ec2_client.requested)
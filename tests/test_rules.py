@@ -0,0 +1,60 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+from rules import compact_rules, count_rules, merge_port_ranges
+
+
+def rule(protocol, from_port, to_port, *cidrs):
+    return {'IpProtocol': protocol, 'FromPort': from_port, 'ToPort': to_port,
+            'IpRanges': [{'CidrIp': cidr} for cidr in cidrs]}
+
+
+def test_all_traffic_rule_drops_the_rules_it_covers():
+    rules = [rule('-1', -1, -1, '0.0.0.0/0'), rule('tcp', 5432, 5432, '0.0.0.0/32'),
+             rule('tcp', 3306, 3306, '0.0.0.0/0'), rule('udp', 53, 53, '10.0.0.0/8')]
+    assert compact_rules(rules) == [rule('-1', -1, -1, '0.0.0.0/0')]
+
+
+def test_broader_port_range_and_network_drop_the_rule_they_cover():
+    rules = [rule('tcp', 20, 30, '10.0.0.0/8'), rule('tcp', 22, 22, '10.1.0.0/16')]
+    assert compact_rules(rules) == [rule('tcp', 20, 30, '10.0.0.0/8')]
+
+
+def test_partly_covered_rules_are_kept():
+    """A wider port range from a narrower network (or another protocol) allows traffic the other rule doesn't"""
+    rules = [rule('tcp', 22, 22, '10.0.0.0/8'), rule('tcp', 20, 30, '10.1.0.0/16'), rule('udp', 22, 22, '10.1.0.0/16')]
+    compacted = compact_rules(rules)
+    assert count_rules(compacted) == 3
+    assert rule('tcp', 20, 30, '10.1.0.0/16') in compacted
+    assert rule('udp', 22, 22, '10.1.0.0/16') in compacted
+
+
+def test_ipv6_rule_does_not_cover_ipv4():
+    rules = [rule('-1', -1, -1, '::/0'), rule('tcp', 22, 22, '1.2.3.4/32')]
+    assert count_rules(compact_rules(rules)) == 2
+
+
+def test_adjacent_and_overlapping_ports_merge():
+    rules = [rule('tcp', 80, 80, '1.2.3.4/32'), rule('tcp', 81, 81, '1.2.3.4/32'), rule('tcp', 82, 90, '1.2.3.4/32'),
+             rule('tcp', 85, 95, '1.2.3.4/32'), rule('tcp', 443, 443, '1.2.3.4/32')]
+    assert compact_rules(rules) == [rule('tcp', 80, 95, '1.2.3.4/32'), rule('tcp', 443, 443, '1.2.3.4/32')]
+
+
+def test_merge_port_ranges():
+    assert merge_port_ranges([(443, 443), (80, 80), (81, 85), (84, 90), (92, 92)]) == [(80, 90), (92, 92), (443, 443)]
+
+
+def test_networks_sharing_a_port_range_collapse_into_one_permission():
+    rules = [rule('tcp', 22, 22, '10.0.0.0/25'), rule('tcp', 22, 22, '10.0.0.128/25', '192.168.1.1/32'),
+             rule('tcp', 22, 22, '192.168.1.1/32')]
+    assert compact_rules(rules) == [rule('tcp', 22, 22, '10.0.0.0/24', '192.168.1.1/32')]
+
+
+def test_rules_without_ip_ranges_pass_through():
+    group_rule = {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'UserIdGroupPairs': [{'GroupId': 'sg-1'}]}
+    compacted = compact_rules([rule('-1', -1, -1, '0.0.0.0/0'), group_rule])
+    assert compacted == [rule('-1', -1, -1, '0.0.0.0/0'), group_rule]
+    assert count_rules(compacted) == 2
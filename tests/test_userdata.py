@@ -0,0 +1,101 @@
+"""--------------------------------------------------------------------------------------------------------------------
+Copyright 2021 Market Maker Lite, LLC (MML)
+Licensed under the Apache License, Version 2.0
+THIS CODE IS PROVIDED AS IS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND
+This file is part of the MML Open Source Library (www.github.com/MarketMakerLite)
+--------------------------------------------------------------------------------------------------------------------"""
+import os
+import shutil
+import subprocess
+import pytest
+import userdata
+from userdata import TOPPINGS, compile_userdata, install_steps
+
+
+def positions(steps):
+    return {step: i for i, (step, prerequisites, commands) in enumerate(steps)}
+
+
+@pytest.mark.parametrize('toppings', [[], ['Redis'], ['Postgres', 'Docker', 'Airflow'], list(TOPPINGS)])
+def test_every_step_comes_after_its_prerequisites(toppings):
+    steps = install_steps(toppings)
+    order = positions(steps)
+    assert len(order) == len(steps)
+    for step, prerequisites, commands in steps:
+        for prerequisite in prerequisites:
+            assert order[prerequisite] < order[step], (prerequisite, step)
+
+
+def test_repos_need_their_keys_and_apt_needs_every_repo():
+    steps = {step: prerequisites for step, prerequisites, commands in install_steps(['Postgres', 'Docker', 'Redis'])}
+    assert steps['key-postgres'] == [] and steps['key-docker'] == []
+    assert steps['repo-postgres'] == ['key-postgres']
+    assert sorted(steps['apt-update']) == ['repo-docker', 'repo-postgres']
+    assert steps['apt-upgrade'] == ['apt-update']
+    assert steps['apt-install'] == ['apt-upgrade']
+    assert steps['service-redis-server'] == ['apt-install']
+
+
+def test_post_install_waits_for_the_toppings_it_requires():
+    steps = {step: prerequisites for step, prerequisites, commands in install_steps(['Airflow'])}
+    assert steps['post-base'] == ['apt-install']
+    assert steps['post-airflow'] == ['apt-install', 'post-base']
+
+
+def test_packages_are_installed_once_in_one_transaction():
+    apt_installs = [commands for step, prerequisites, commands in install_steps(['MongoDB', 'Docker'])
+                    if step == 'apt-install']
+    assert len(apt_installs) == 1
+    packages = apt_installs[0][0].split(' install ')[1].split()
+    assert packages.count('gnupg') == 1
+    assert 'mongodb-org' in packages and 'docker-ce' in packages
+
+
+@pytest.mark.skipif(shutil.which('bash') is None, reason='needs bash')
+def test_failed_step_skips_what_depends_on_it_and_reports_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(userdata, 'STEPS_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(userdata, 'install_steps', lambda toppings: [
+        ('ok', [], ['true']),
+        ('broken', [], ['false']),
+        ('after-ok', ['ok'], ['true']),
+        ('after-broken', ['broken'], [f'touch {tmp_path}/ran']),
+        ('after-both', ['after-ok', 'after-broken'], ['true']),
+    ])
+    parts = compile_userdata([], ready_marker='READY', failed_marker='FAILED')
+    subprocess.run(['bash', '-c', parts[0]['content']], check=True, timeout=30)
+
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(('.done', '.failed'))) == [
+        'after-both.failed', 'after-broken.failed', 'after-ok.done', 'broken.failed', 'ok.done']
+    assert not (tmp_path / 'ran').exists()
+
+    """The finish part reports the failed steps instead of scheduling the ready marker and restarting"""
+    finish = parts[-1]['content'].replace('> /dev/console', '').replace('shutdown -r now', 'echo RESTART')
+    finished = subprocess.run(['bash', '-c', finish], capture_output=True, text=True, timeout=30)
+    assert finished.returncode == 1
+    assert finished.stdout.split() == ['FAILED', 'after-both', 'after-broken', 'broken']
+
+
+@pytest.mark.skipif(shutil.which('bash') is None, reason='needs bash')
+def test_successful_steps_all_finish(tmp_path, monkeypatch):
+    monkeypatch.setattr(userdata, 'STEPS_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(userdata, 'install_steps', lambda toppings: [
+        ('first', [], ['true']), ('second', ['first'], ['true'])])
+    parts = compile_userdata([], ready_marker='READY', failed_marker='FAILED')
+    subprocess.run(['bash', '-c', parts[0]['content']], check=True, timeout=30)
+    assert not list(tmp_path.glob('*.failed'))
+    assert sorted(path.name for path in tmp_path.glob('*.done')) == ['first.done', 'second.done']
+
+
+@pytest.mark.skipif(shutil.which('bash') is None, reason='needs bash')
+def test_step_fails_on_any_failing_command_or_pipe(tmp_path, monkeypatch):
+    monkeypatch.setattr(userdata, 'STEPS_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(userdata, 'install_steps', lambda toppings: [
+        ('early-failure', [], ['false', 'echo ok']),
+        ('broken-pipe', [], ['false | cat']),
+        ('fine', [], ['echo ok | cat', 'true']),
+    ])
+    parts = compile_userdata([], ready_marker='READY', failed_marker='FAILED')
+    subprocess.run(['bash', '-c', parts[0]['content']], check=True, timeout=30)
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(('.done', '.failed'))) == [
+        'broken-pipe.failed', 'early-failure.failed', 'fine.done']
+    assert 'ok' not in (tmp_path / 'early-failure.log').read_text()